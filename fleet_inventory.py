@@ -0,0 +1,206 @@
+import json
+from array import array
+import numpy as np
+
+
+class FleetInventory(object):
+
+    # Columnar inventory of many host scans.  Numeric identify / namespace
+    # fields are kept in numpy columns, strings (host, model, serial,
+    # firmware, bdf) as integer codes into per-column string dictionaries.
+    # Identify data shared between drives (everything except the per drive
+    # fields below, including the power state descriptors) is interned, so
+    # a thousand drives of the same model and firmware share one copy.
+
+    # string dictionary columns and their numeric columns, per controller
+    CTRL_STR_COLUMNS = [ 'host', 'model', 'serial', 'fw', 'bdf' ]
+    CTRL_NUM_COLUMNS = [ 'cntlid', 'capacity', 'id_ctrl' ]
+    # per namespace numeric columns; 'ctrl' is the controller row
+    NS_NUM_COLUMNS   = [ 'ctrl', 'nsid', 'nsze', 'ncap', 'nuse', 'id_ns' ]
+    # identify fields that differ per drive and are not interned
+    ID_CTRL_UNIQUE   = [ 'sn', 'cntlid', 'subnqn', 'fguid' ]
+    ID_NS_UNIQUE     = [ 'nsze', 'ncap', 'nuse', 'nguid', 'eui64' ]
+
+    class StringDictionary(object):
+
+        def __init__(self):
+            self.values = []
+            self.codes  = {}
+
+        def encode(self, value):
+            code = self.codes.get(value, None)
+            if code is None:
+                code = len(self.values)
+                self.values.append(value)
+                self.codes.update({ value: code })
+            return code
+
+        def decode(self, code):
+            return self.values[code]
+
+        def __len__(self):
+            return len(self.values)
+
+    def __init__(self):
+        self.str_dicts   = dict([ (name, self.StringDictionary()) for name in self.CTRL_STR_COLUMNS ])
+        # build buffers, converted to numpy columns on first query
+        self._ctrl_buf   = dict([ (name, array('q')) for name in self.CTRL_STR_COLUMNS + self.CTRL_NUM_COLUMNS ])
+        self._ns_buf     = dict([ (name, array('q')) for name in self.NS_NUM_COLUMNS ])
+        self._ctrl_cols  = None
+        self._ns_cols    = None
+        # interned identify structures; payload list is indexed by the
+        # 'id_ctrl' / 'id_ns' columns, per drive fields are kept aside
+        self._intern     = {}
+        self._payloads   = []
+        self._ctrl_extra = []
+
+    # return the interned copy of an identify structure, and its code
+    def _intern_payload(self, payload):
+        key  = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+        code = self._intern.get(key, None)
+        if code is None:
+            code = len(self._payloads)
+            # power state descriptors repeat between models too
+            if 'psds' in payload:
+                payload = dict(payload)
+                payload.update({ 'psds': [ self._payloads[self._intern_payload(psd)] for psd in payload['psds'] ] })
+                code = len(self._payloads)
+            self._payloads.append(payload)
+            self._intern.update({ key: code })
+        return code
+
+    @staticmethod
+    def _split(payload, unique_keys):
+        shared = dict([ (key, value) for key, value in payload.items() if not (key in unique_keys) ])
+        unique = dict([ (key, value) for key, value in payload.items() if key in unique_keys ])
+        return shared, unique
+
+    # add the controllers and namespaces of a full_scan
+    def add_scan(self, full_scan, host):
+        host_code = self.str_dicts['host'].encode(host)
+        for dev_data in full_scan.get('ctrl_list', []):
+            id_ctrl = dev_data.get('id_ctrl') or {}
+            shared, unique = self._split(id_ctrl, self.ID_CTRL_UNIQUE)
+            ctrl_row = len(self._ctrl_extra)
+            self._ctrl_extra.append(unique)
+            self._ctrl_buf['host'].append(host_code)
+            self._ctrl_buf['model'].append(self.str_dicts['model'].encode(id_ctrl.get('mn', '').strip()))
+            self._ctrl_buf['serial'].append(self.str_dicts['serial'].encode(id_ctrl.get('sn', '').strip()))
+            self._ctrl_buf['fw'].append(self.str_dicts['fw'].encode(id_ctrl.get('fr', '').strip()))
+            self._ctrl_buf['bdf'].append(self.str_dicts['bdf'].encode(dev_data.get('bdf', '')))
+            cntlid = dev_data.get('cntlid', None)
+            self._ctrl_buf['cntlid'].append(-1 if cntlid is None else cntlid)
+            self._ctrl_buf['capacity'].append(id_ctrl.get('tnvmcap', 0))
+            self._ctrl_buf['id_ctrl'].append(self._intern_payload(shared))
+            for ns_item in (dev_data.get('list_ns') or []):
+                id_ns = ns_item.get('id_ns') or {}
+                shared, unique = self._split(id_ns, self.ID_NS_UNIQUE)
+                self._ns_buf['ctrl'].append(ctrl_row)
+                self._ns_buf['nsid'].append(ns_item['ns_id'])
+                for name in [ 'nsze', 'ncap', 'nuse' ]:
+                    self._ns_buf[name].append(id_ns.get(name, 0))
+                self._ns_buf['id_ns'].append(self._intern_payload(shared))
+        self._ctrl_cols = None
+        self._ns_cols   = None
+
+    def _columns(self):
+        if self._ctrl_cols is None:
+            self._ctrl_cols = dict([ (name, np.array(buf, dtype=np.int64)) for name, buf in self._ctrl_buf.items() ])
+            self._ns_cols   = dict([ (name, np.array(buf, dtype=np.int64)) for name, buf in self._ns_buf.items() ])
+        return self._ctrl_cols, self._ns_cols
+
+    def ctrl_count(self):
+        return len(self._ctrl_extra)
+
+    def ns_count(self):
+        return len(self._ns_buf['ctrl'])
+
+    # numpy column of the controllers, string columns are returned as codes
+    def ctrl_column(self, name):
+        return self._columns()[0][name]
+
+    # numpy column of the namespaces
+    def ns_column(self, name):
+        return self._columns()[1][name]
+
+    # reassemble the identify controller data of a controller row
+    def id_ctrl(self, ctrl_row):
+        id_ctrl = dict(self._payloads[self._ctrl_buf['id_ctrl'][ctrl_row]])
+        id_ctrl.update(self._ctrl_extra[ctrl_row])
+        return id_ctrl
+
+    # Returns a boolean controller mask, all keyword arguments must match.
+    # String columns are compared by value, e.g.:
+    #   mask = fleet.ctrl_mask(model='Micron_7450_MTFDKCC960TFR', fw='E2MU200')
+    #   mask &= fleet.ctrl_column('capacity') > 1 << 40
+    def ctrl_mask(self, **kwargs):
+        mask = np.ones(self.ctrl_count(), dtype=bool)
+        for name, value in kwargs.items():
+            if name in self.str_dicts:
+                code = self.str_dicts[name].codes.get(value, None)
+                if code is None:
+                    return np.zeros(self.ctrl_count(), dtype=bool)
+                mask &= self.ctrl_column(name) == code
+            else:
+                mask &= self.ctrl_column(name) == value
+        return mask
+
+    # namespace mask of all namespaces of the controllers in ctrl_mask
+    def ns_mask(self, ctrl_mask):
+        return ctrl_mask[self.ns_column('ctrl')]
+
+    # sum weights (or count rows if None) per group; integer sums so large
+    # capacity totals don't lose precision.
+    def _group(self, codes, by, weights):
+        if by in self.str_dicts:
+            values  = np.arange(len(self.str_dicts[by]))
+            inverse = codes
+        else:
+            values, inverse = np.unique(codes, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(values))
+        if weights is None:
+            sums = counts
+        else:
+            sums = np.zeros(len(values), dtype=np.int64)
+            np.add.at(sums, inverse, weights)
+        ret_dict = {}
+        for index in np.flatnonzero(counts):
+            if by in self.str_dicts:
+                key = self.str_dicts[by].decode(index)
+            else:
+                key = values[index].item()
+            ret_dict.update({ key: sums[index].item() })
+        return ret_dict
+
+    # Returns { group value: controller count } for the controllers in mask
+    def count_by(self, by, mask=None):
+        codes = self.ctrl_column(by)
+        if not (mask is None):
+            codes = codes[mask]
+        return self._group(codes, by, None)
+
+    # Returns { group value: sum of column } for the controllers in mask
+    def sum_by(self, column, by, mask=None):
+        codes   = self.ctrl_column(by)
+        weights = self.ctrl_column(column)
+        if not (mask is None):
+            codes   = codes[mask]
+            weights = weights[mask]
+        return self._group(codes, by, weights)
+
+    # Returns { group value: namespace count / sum of namespace column },
+    # grouped by a controller column; mask is a controller mask.
+    def ns_count_by(self, by, mask=None):
+        return self.ns_sum_by(None, by, mask)
+
+    def ns_sum_by(self, column, by, mask=None):
+        ns_ctrl = self.ns_column('ctrl')
+        weights = None
+        if not (column is None):
+            weights = self.ns_column(column)
+        if not (mask is None):
+            ns_sel  = self.ns_mask(mask)
+            ns_ctrl = ns_ctrl[ns_sel]
+            if not (weights is None):
+                weights = weights[ns_sel]
+        return self._group(self.ctrl_column(by)[ns_ctrl], by, weights)
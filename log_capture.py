@@ -0,0 +1,154 @@
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+class TelemetryLog(object):
+
+    # Read access to a captured telemetry log file (host or controller
+    # initiated).  The file is memory mapped and header fields / data areas
+    # are returned as memoryview slices of the mapping, nothing is copied.
+    #
+    # Header (block 0), all values little endian:
+    #   byte  0       log identifier (07h host, 08h controller initiated)
+    #   bytes 5:7     IEEE OUI
+    #   bytes 8:9     data area 1 last block
+    #   bytes 10:11   data area 2 last block
+    #   bytes 12:13   data area 3 last block
+    #   bytes 16:19   data area 4 last block
+    #   byte  382     controller-initiated data available
+    #   byte  383     controller-initiated data generation number
+    #   bytes 384:511 reason identifier
+    #
+    BLOCK_SIZE = 512
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file     = open(file_path, 'rb')
+        self._mmap     = None
+        self._view     = None
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mmap)
+        except ValueError:
+            self._file.close()
+            raise ValueError("empty telemetry log: {}".format(file_path))
+        if len(self._view) < self.BLOCK_SIZE:
+            self.close()
+            raise ValueError("truncated telemetry log header: {}".format(file_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # memoryviews handed out must be released before closing
+    def close(self):
+        if not (self._view is None):
+            self._view.release()
+            self._view = None
+        if not (self._mmap is None):
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def size(self):
+        return len(self._view)
+
+    def log_id(self):
+        return self._view[0]
+
+    def ieee_oui(self):
+        return self._view[5:8]
+
+    # last block of each data area 1..4
+    def area_last_blocks(self):
+        return list(struct.unpack_from('<HHH', self._view, 8)) + [ struct.unpack_from('<I', self._view, 16)[0] ]
+
+    def ctrl_data_available(self):
+        return self._view[382]
+
+    def ctrl_data_generation(self):
+        return self._view[383]
+
+    def reason_id(self):
+        return self._view[384:512]
+
+    # returns a memoryview of data area 1..4, clipped to what was captured;
+    # each area follows the previous one, area 1 starts after the header.
+    def data_area(self, area):
+        if not (area in [ 1, 2, 3, 4 ]):
+            raise IndexError("invalid telemetry data area: {}".format(area))
+        last_blocks = [ 0 ] + self.area_last_blocks()
+        first_block = last_blocks[area - 1] + 1
+        last_block  = last_blocks[area]
+        if last_block < first_block:
+            return self._view[0:0]
+        start = min(first_block * self.BLOCK_SIZE, len(self._view))
+        end   = min((last_block + 1) * self.BLOCK_SIZE, len(self._view))
+        return self._view[start:end]
+
+    def summary(self):
+        last_blocks = self.area_last_blocks()
+        return {
+            'log_id':         self.log_id(),
+            'ieee_oui':       self.ieee_oui().hex(),
+            'size':           self.size(),
+            'area_last':      last_blocks,
+            'area_sizes':     [ len(self.data_area(area)) for area in [ 1, 2, 3, 4 ] ],
+            'ctrl_available': self.ctrl_data_available(),
+            'ctrl_gen':       self.ctrl_data_generation()
+        }
+
+
+class LogCapture(object):
+
+    # Capture logs from many drives at once; at most max_in_flight captures
+    # run concurrently, so a large fleet doesn't start a telemetry capture
+    # on every drive at the same time.  Logs are streamed by the capture
+    # command straight into files in out_dir.
+    #
+    #   tools_hlpr:    LinuxToolsHelper used to run the captures
+    #   out_dir:       directory for the captured files, created if missing
+    #   max_in_flight: number of concurrent captures
+    #
+    def __init__(self, tools_hlpr, out_dir, max_in_flight=4):
+        self.tools_hlpr    = tools_hlpr
+        self.out_dir       = out_dir
+        self.max_in_flight = max_in_flight
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _file_path(self, dev_node, log_name):
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        return os.path.join(self.out_dir, "{}_{}_{}.bin".format(os.path.basename(dev_node), log_name, timestamp))
+
+    def _run(self, capture_fn, dev_nodes):
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            return list(executor.map(capture_fn, dev_nodes))
+
+    def _capture_telemetry(self, dev_node, host_init, data_area):
+        log_name  = 'telemetry_host' if host_init else 'telemetry_ctrl'
+        file_path = self._file_path(dev_node, log_name)
+        ret_code, size = self.tools_hlpr.nvme_get_telemetry_log(dev_node, file_path, host_init, data_area)
+        result = { 'dev_node': dev_node, 'file': file_path, 'ret_code': ret_code, 'size': size, 'header': None }
+        if (ret_code == 0) and (size >= TelemetryLog.BLOCK_SIZE):
+            with TelemetryLog(file_path) as telemetry:
+                result['header'] = telemetry.summary()
+        return result
+
+    # Returns a list of result dicts, one per dev node in order:
+    #   { 'dev_node', 'file', 'ret_code', 'size', 'header': TelemetryLog.summary() }
+    def capture_telemetry(self, dev_nodes, host_init=True, data_area=3):
+        return self._run(lambda dev_node: self._capture_telemetry(dev_node, host_init, data_area), dev_nodes)
+
+    def _capture_log(self, dev_node, log_id, log_len):
+        file_path = self._file_path(dev_node, "log{:02x}".format(log_id))
+        ret_code, size = self.tools_hlpr.nvme_get_log_raw(dev_node, file_path, log_id, log_len)
+        return { 'dev_node': dev_node, 'file': file_path, 'ret_code': ret_code, 'size': size }
+
+    # capture a (vendor specific) log page from each dev node
+    def capture_log(self, dev_nodes, log_id, log_len):
+        return self._run(lambda dev_node: self._capture_log(dev_node, log_id, log_len), dev_nodes)
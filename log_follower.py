@@ -0,0 +1,287 @@
+import json
+import os
+import struct
+import time
+
+
+class LogFollower(object):
+
+    # Common part of the log followers: the position per controller is kept
+    # in a json state file keyed by serial number and controller id
+    # ("<serial>:<cntlid>", the ports of a dual port drive share the serial
+    # but each has its own logs), so a restarted follower continues where it
+    # left off.  poll_ctrl() is implemented by each follower.
+    #
+    #   tools_hlpr: LinuxToolsHelper used to query the drives
+    #   state_file: path of the json state file, created if missing
+    #   dev_nodes:  controller dev nodes to follow, default is all found
+    #   from_start: on first sight of a drive, return the entries still in
+    #               its log instead of starting at the current position
+    #
+    def __init__(self, tools_hlpr, state_file, dev_nodes=None, from_start=False):
+        self.tools_hlpr = tools_hlpr
+        self.state_file = state_file
+        self.from_start = from_start
+        if dev_nodes is None:
+            dev_nodes = tools_hlpr.find_nvme_dev_nodes()
+        self.dev_nodes  = dev_nodes
+        # dev_node: { 'serial', 'cntlid', 'elpe', 'lpa' } from identify, read once
+        self._ctrl_info = {}
+        self.state      = self.load_state()
+        self._saved     = json.dumps(self.state, sort_keys=True)
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, 'r') as in_file:
+            return json.load(in_file)
+
+    # write to a temporary file first, a partly written state file would
+    # lose the position of every drive; nothing is written if unchanged.
+    def save_state(self):
+        state_str = json.dumps(self.state, sort_keys=True)
+        if state_str == self._saved:
+            return
+        self._saved = state_str
+        tmp_file = "{}.tmp".format(self.state_file)
+        with open(tmp_file, 'w') as out_file:
+            out_file.write(state_str)
+        os.replace(tmp_file, self.state_file)
+
+    def _get_ctrl_info(self, dev_node):
+        ctrl_info = self._ctrl_info.get(dev_node, None)
+        if ctrl_info is None:
+            id_ctrl = self.tools_hlpr.nvme_get_ctrl_identify(dev_node)
+            if not ('sn' in id_ctrl):
+                return None
+            ctrl_info = { 'serial': id_ctrl['sn'].strip(), 'cntlid': id_ctrl.get('cntlid', 0),
+                          'elpe': id_ctrl.get('elpe', 0), 'lpa': id_ctrl.get('lpa', 0) }
+            self._ctrl_info.update({ dev_node: ctrl_info })
+        return ctrl_info
+
+    @staticmethod
+    def _ctrl_key(ctrl_info):
+        return "{}:{}".format(ctrl_info['serial'], ctrl_info['cntlid'])
+
+    # Returns the new entries of one controller, oldest first, and updates
+    # the position of the controller.  Returns None if the drive could not
+    # be queried.
+    def poll_ctrl(self, dev_node):
+        raise NotImplementedError()
+
+    # Returns a list of (dev_node, serial, entry) of all new entries of all
+    # followed controllers and saves the new positions.
+    def poll(self):
+        new_entries = []
+        for dev_node in self.dev_nodes:
+            entries = self.poll_ctrl(dev_node)
+            if entries is None:
+                continue
+            serial = self._ctrl_info[dev_node]['serial']
+            new_entries += [ (dev_node, serial, entry) for entry in entries ]
+        self.save_state()
+        return new_entries
+
+    # generator of (dev_node, serial, entry) of new entries, polling every
+    # interval seconds; stops after polls polls if given.
+    def follow(self, interval=5.0, polls=None):
+        poll_num = 0
+        while (polls is None) or (poll_num < polls):
+            if poll_num > 0:
+                time.sleep(interval)
+            for new_entry in self.poll():
+                yield new_entry
+            poll_num += 1
+
+
+class ErrorLogFollower(LogFollower):
+
+    # Follows the error logs of many controllers and returns only entries
+    # that are new since the last poll.  The SMART log error count is checked
+    # first (one small log page); the error log itself is only read when the
+    # count went up, and then only as many entries as are new.  The position
+    # is the last seen error count.
+    def poll_ctrl(self, dev_node):
+        ctrl_info = self._get_ctrl_info(dev_node)
+        if ctrl_info is None:
+            return None
+        smart = self.tools_hlpr.nvme_get_smart_log(dev_node)
+        if not ('num_err_log_entries' in smart):
+            return None
+        err_count  = smart['num_err_log_entries']
+        ctrl_key   = self._ctrl_key(ctrl_info)
+        drv_state  = self.state.get(ctrl_key, None)
+        if drv_state is None:
+            drv_state = { 'error_count': 0 if self.from_start else err_count }
+            self.state.update({ ctrl_key: drv_state })
+        drv_state.update({ 'dev_node': dev_node })
+        last_count = drv_state['error_count']
+        if err_count < last_count:
+            # count went backwards, e.g. the drive was replaced or reset
+            self.tools_hlpr.log('WARN', "{} error count reset {} -> {}".format(dev_node, last_count, err_count))
+            drv_state.update({ 'error_count': err_count })
+            return []
+        if err_count == last_count:
+            return []
+        # the log holds at most elpe + 1 entries, older ones are lost
+        new_count = err_count - last_count
+        max_count = ctrl_info['elpe'] + 1
+        if new_count > max_count:
+            self.tools_hlpr.log('WARN', "{} missed {} error log entries".format(dev_node, new_count - max_count))
+            new_count = max_count
+        entries = self.tools_hlpr.nvme_get_error_log(dev_node, new_count)
+        if entries is None:
+            return None
+        entries = [ entry for entry in entries if entry.get('error_count', 0) > last_count ]
+        entries.sort(key=lambda entry: entry['error_count'])
+        drv_state.update({ 'error_count': err_count })
+        return entries
+
+
+class EventLogFollower(LogFollower):
+
+    # Follows the persistent event logs (log page 0Dh) of many controllers.
+    # Every poll establishes a reporting context and reads the 512 byte log
+    # header; nothing else is read unless the total number of events went
+    # up.  New events are appended to the log, so only the bytes from the
+    # end of the last seen event to the end of the log are read, under the
+    # same context, which is released again at the end of the poll.  The
+    # position is the total number of events, the byte offset of the end of
+    # the last seen event, its timestamp and the log generation number.
+    #
+    # Header, all values little endian:
+    #   byte  0       log identifier (0Dh)
+    #   bytes 4:7     total number of events
+    #   bytes 8:15    total log length
+    #   bytes 372:373 generation number
+    #
+    # Event header:
+    #   byte  0       event type
+    #   byte  1       event type revision
+    #   byte  2       event header length (bytes after this field)
+    #   bytes 4:5     controller id
+    #   bytes 6:13    event timestamp (bits 47:0 milliseconds)
+    #   bytes 20:21   vendor specific information length
+    #   bytes 22:23   event length (bytes after the event header)
+    #
+    LOG_ID      = 0x0D
+    HEADER_SIZE = 512
+    # log specific field: context action
+    LSP_READ    = 0
+    LSP_OPEN    = 1
+    LSP_RELEASE = 2
+
+    def __init__(self, tools_hlpr, state_file, dev_nodes=None, from_start=False):
+        super().__init__(tools_hlpr, state_file, dev_nodes, from_start)
+        # log pages are captured here and read back
+        self.work_file = "{}.log.tmp".format(state_file)
+
+    # read log_len bytes of the log at byte offset, None on failure; the
+    # offset sent to the drive is aligned down to a dword.
+    def _read_log(self, dev_node, offset, log_len, lsp):
+        lpo = offset & ~3
+        ret_code, size = self.tools_hlpr.nvme_get_log_raw(dev_node, self.work_file, self.LOG_ID,
+                                                          log_len + offset - lpo, lsp=lsp, lpo=lpo)
+        if ret_code != 0:
+            return None
+        with open(self.work_file, 'rb') as in_file:
+            log_data = in_file.read()
+        os.remove(self.work_file)
+        return log_data[offset - lpo:]
+
+    # parse the events in log_data, base is the log offset of log_data;
+    # returns the events and the log offset after the last complete event.
+    @staticmethod
+    def parse_events(log_data, base=0):
+        events = []
+        pos    = 0
+        while pos + 24 <= len(log_data):
+            hdr_len   = log_data[pos + 2] + 3
+            vsil, evl = struct.unpack_from('<HH', log_data, pos + 20)
+            end       = pos + hdr_len + evl
+            if (hdr_len < 24) or (end > len(log_data)):
+                break
+            timestamp = struct.unpack_from('<Q', log_data, pos + 6)[0] & 0xFFFFFFFFFFFF
+            events.append({
+                'event_type': log_data[pos],
+                'event_rev':  log_data[pos + 1],
+                'cntlid':     struct.unpack_from('<H', log_data, pos + 4)[0],
+                'timestamp':  timestamp,
+                'offset':     base + pos,
+                'vendor':     log_data[pos + hdr_len:pos + hdr_len + vsil].hex(),
+                'data':       log_data[pos + hdr_len + vsil:end].hex()
+            })
+            pos = end
+        return events, base + pos
+
+    def poll_ctrl(self, dev_node):
+        ctrl_info = self._get_ctrl_info(dev_node)
+        if ctrl_info is None:
+            return None
+        # lpa bit 4: persistent event log supported
+        if not (ctrl_info['lpa'] & 0x10):
+            return None
+        header = self._read_log(dev_node, 0, self.HEADER_SIZE, self.LSP_OPEN)
+        try:
+            if (header is None) or (len(header) < self.HEADER_SIZE) or (header[0] != self.LOG_ID):
+                return None
+            return self._poll_events(dev_node, ctrl_info, header)
+        finally:
+            self._read_log(dev_node, 0, self.HEADER_SIZE, self.LSP_RELEASE)
+
+    def _poll_events(self, dev_node, ctrl_info, header):
+        total_events, log_len = struct.unpack_from('<IQ', header, 4)
+        generation = struct.unpack_from('<H', header, 372)[0]
+        ctrl_key   = self._ctrl_key(ctrl_info)
+        drv_state  = self.state.get(ctrl_key, None)
+        if drv_state is None:
+            if self.from_start:
+                drv_state = { 'events': 0, 'offset': self.HEADER_SIZE, 'timestamp': None }
+            else:
+                drv_state = { 'events': total_events, 'offset': log_len, 'timestamp': None }
+            drv_state.update({ 'generation': generation })
+            self.state.update({ ctrl_key: drv_state })
+        drv_state.update({ 'dev_node': dev_node })
+        last_events = drv_state['events']
+        if (generation != drv_state['generation']) or (total_events < last_events):
+            # the log was cleared or the drive replaced
+            self.tools_hlpr.log('WARN', "{} persistent event log reset, {} -> {} events".format(
+                dev_node, last_events, total_events))
+            drv_state.update({ 'events': total_events, 'offset': log_len, 'timestamp': None,
+                               'generation': generation })
+            return []
+        if total_events == last_events:
+            return []
+        new_count = total_events - last_events
+        offset    = drv_state['offset']
+        events    = []
+        end       = offset
+        if offset < log_len:
+            log_data = self._read_log(dev_node, offset, log_len - offset, self.LSP_READ)
+            if log_data is None:
+                return None
+            events, end = self.parse_events(log_data, offset)
+        if (len(events) != new_count) or (end != log_len):
+            # the oldest events were dropped to make room and the events
+            # moved, find the last seen event in the whole log instead
+            log_data = self._read_log(dev_node, self.HEADER_SIZE, log_len - self.HEADER_SIZE, self.LSP_READ)
+            if log_data is None:
+                return None
+            events, end = self.parse_events(log_data, self.HEADER_SIZE)
+            seen = [ index for index, event in enumerate(events)
+                     if event['timestamp'] == drv_state['timestamp'] ]
+            if len(seen) > 0:
+                events = events[seen[-1] + 1:]
+            elif len(events) > new_count:
+                events = events[len(events) - new_count:]
+            if len(events) < new_count:
+                self.tools_hlpr.log('WARN', "{} missed {} persistent events".format(
+                    dev_node, new_count - len(events)))
+        # events are numbered by the total event count, the last one is
+        # total_events
+        for index, event in enumerate(events):
+            event.update({ 'event_number': total_events - len(events) + index + 1 })
+        drv_state.update({ 'events': total_events, 'offset': end })
+        if len(events) > 0:
+            drv_state.update({ 'timestamp': events[-1]['timestamp'] })
+        return events
@@ -1,8 +1,13 @@
 import argparse
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tools_helper import LinuxToolsHelper
+from scan_diff import NvmeScanDiff, load_scan
+from scan_store import NvmeScanStore
+from scan_exporter import NvmeMetricsCollector, make_exporter
+from scan_query import ScanQuery
 
 
 class NvmeScanOptions(object):
@@ -13,6 +18,19 @@ class NvmeScanOptions(object):
         self.dev_ref   = None
         self.diff_scan = False
         self.data_file = None
+        # sub command, 'scan' unless one is given on the command line
+        self.command    = 'scan'
+        self.diff_files = None
+        self.diff_ctrl_fields = None
+        self.diff_ns_fields   = None
+        self.store_db    = None
+        self.store_files = None
+        self.store_host  = None
+        self.export_addr     = '127.0.0.1'
+        self.export_port     = 9998
+        self.export_interval = 60.0
+        self.query      = None
+        self.query_file = None
 
     def set_scan_bdf(self, bdf):
         self.scan_type = 'BDF'
@@ -42,6 +60,50 @@ class NvmeScanOptions(object):
             return 1
         return 0
 
+    def set_diff_files(self, old_file, new_file):
+        for file_path in [ old_file, new_file ]:
+            if not os.path.isfile(file_path):
+                print("ERR: invalid scan file {} specified, ignoring input".format(file_path))
+                return 1
+        self.command    = 'diff'
+        self.diff_files = [ old_file, new_file ]
+        return 0
+
+    def set_store_files(self, db_path, file_list, host=None):
+        for file_path in file_list:
+            if not os.path.isfile(file_path):
+                print("ERR: invalid scan file {} specified, ignoring input".format(file_path))
+                return 1
+        self.command     = 'store'
+        self.store_db    = db_path
+        self.store_files = file_list
+        self.store_host  = host
+        return 0
+
+    def set_export(self, addr, port, interval):
+        if interval <= 0:
+            print("ERR: invalid scan interval {}, ignoring input".format(interval))
+            return 1
+        self.command         = 'export'
+        self.export_addr     = addr
+        self.export_port     = port
+        self.export_interval = interval
+        return 0
+
+    def set_query(self, query_str, file_path=None):
+        try:
+            query = ScanQuery(query_str)
+        except ValueError as exc:
+            print("ERR: {}, ignoring input".format(exc))
+            return 1
+        if not ((file_path is None) or os.path.isfile(file_path)):
+            print("ERR: invalid scan file {} specified, ignoring input".format(file_path))
+            return 1
+        self.command    = 'query'
+        self.query      = query
+        self.query_file = file_path
+        return 0
+
 
 def get_args(args_test=None):
     parser = argparse.ArgumentParser(prog="NVMe device scan CLI")
@@ -53,6 +115,31 @@ def get_args(args_test=None):
                         help='Rescan by device DBDF e.g. -b 0000:02:00.0.')
     parser.add_argument('-n', '--node', required=False, dest='dev_node', default=None,
                         help='Rescan by dev node name e.g. -n /dev/nvme0')
+    sub_parsers = parser.add_subparsers(dest='command')
+    diff_parser = sub_parsers.add_parser('diff', help='Offline diff of two saved scan files.')
+    diff_parser.add_argument('old_file', help='Scan file used as the basis of the diff.')
+    diff_parser.add_argument('new_file', help='Scan file compared against the basis.')
+    diff_parser.add_argument('--ctrl-fields', required=False, dest='ctrl_fields', default=None,
+                             help='Comma separated controller fields to compare e.g. fw,bdf')
+    diff_parser.add_argument('--ns-fields', required=False, dest='ns_fields', default=None,
+                             help='Comma separated namespace fields to compare e.g. nsze')
+    store_parser = sub_parsers.add_parser('store', help='Add saved scan files to the scan history database.')
+    store_parser.add_argument('--db', required=True, dest='db_path',
+                              help='Path to the sqlite scan history database, created if missing.')
+    store_parser.add_argument('--host', required=False, dest='host', default=None,
+                              help='Host name the scans were taken on, default is the local host.')
+    store_parser.add_argument('scan_files', nargs='+', help='Scan files to add.')
+    export_parser = sub_parsers.add_parser('export', help='Serve OpenMetrics on /metrics, scanning in the background.')
+    export_parser.add_argument('--addr', required=False, dest='addr', default='127.0.0.1',
+                               help='Address to listen on, default 127.0.0.1.')
+    export_parser.add_argument('--port', required=False, dest='port', type=int, default=9998,
+                               help='Port to listen on, default 9998.')
+    export_parser.add_argument('--interval', required=False, dest='interval', type=float, default=60.0,
+                               help='Seconds between background scans, default 60.')
+    query_parser = sub_parsers.add_parser('query', help='List controllers matching a query.')
+    query_parser.add_argument('query_str', help='Query e.g. \'model~"7450" and fw<"E2MU200" and root=0000:00:01.1\'')
+    query_parser.add_argument('scan_file', nargs='?', default=None,
+                              help='Saved scan file to query, default is to scan the devices.')
     if args_test is None:
         args = parser.parse_args()
     else:
@@ -72,21 +159,67 @@ def get_args(args_test=None):
     # determine if we are doing a change scan, or fresh scan
     if not (args.data_file_in is None):
         ret_args.set_data_file(args.data_file_in)
+    # offline diff of two scan files
+    if args.command == 'diff':
+        ret_args.set_diff_files(args.old_file, args.new_file)
+        if not (args.ctrl_fields is None):
+            ret_args.diff_ctrl_fields = args.ctrl_fields.split(',')
+        if not (args.ns_fields is None):
+            ret_args.diff_ns_fields = args.ns_fields.split(',')
+    # add scan files to the history database
+    if args.command == 'store':
+        ret_args.set_store_files(args.db_path, args.scan_files, args.host)
+    # serve metrics from a cached background scan
+    if args.command == 'export':
+        ret_args.set_export(args.addr, args.port, args.interval)
+    # query a saved scan file or a new scan
+    if args.command == 'query':
+        ret_args.set_query(args.query_str, args.scan_file)
     return ret_args
 
 
 class NvmeDeviceCollector(object):
 
+    # feature id: (name, check if supported based on id_ctrl); features
+    # without a check are mandatory for an NVMe PCIe controller.
+    FEATURES = {
+        0x01: ('arbitration',       None),
+        0x02: ('power_mgmt',        None),
+        0x04: ('temp_threshold',    None),
+        0x05: ('error_recovery',    None),
+        0x06: ('volatile_wc',       lambda id_ctrl: id_ctrl.get('vwc', 0) & 0x1),
+        0x07: ('num_queues',        None),
+        0x08: ('irq_coalescing',    None),
+        0x0A: ('write_atomicity',   None),
+        0x0B: ('async_event_cfg',   None),
+        0x0C: ('apst',              lambda id_ctrl: id_ctrl.get('apsta', 0) & 0x1),
+        0x0D: ('host_mem_buffer',   lambda id_ctrl: id_ctrl.get('hmpre', 0) > 0),
+        0x0E: ('timestamp',         lambda id_ctrl: id_ctrl.get('oncs', 0) & 0x40),
+        0x10: ('host_thermal_mgmt', lambda id_ctrl: id_ctrl.get('hctma', 0) & 0x1)
+    }
+    DEFAULT_FEATURES = [ 0x01, 0x02, 0x04, 0x06, 0x07, 0x08, 0x0B, 0x0C, 0x10 ]
+
     # (optional) argument full_scan:<dict> data from a previous scan
     #            can be loaded in to perform diff any time.
+    # (optional) argument tools_hlpr:<LinuxToolsHelper> helper to use for
+    #            device queries, e.g. with custom command timeouts.
+    # (optional) argument feature_ids:<list> feature ids to snapshot on each
+    #            new_scan, see feature_snapshot(); default is no snapshot.
+    # (optional) argument max_workers:<int> concurrent get-feature commands.
     #
     def __init__(self, **kwargs):
         # TODO: implement option to connect to remote server over ssh
-        self.tools_hlpr = LinuxToolsHelper()
-        self.full_scan  = kwargs.get('full_scan', {})
+        self.tools_hlpr = kwargs.get('tools_hlpr', None)
+        if self.tools_hlpr is None:
+            self.tools_hlpr = LinuxToolsHelper()
+        self.full_scan   = kwargs.get('full_scan', {})
+        self.feature_ids = kwargs.get('feature_ids', None)
+        self.max_workers = kwargs.get('max_workers', 8)
 
-    def diff_scan(self, prev_scan):
-        raise NotImplemented("ERROR: not implemented yet!")
+    # returns the list of changes between prev_scan and the current scan data,
+    # see NvmeScanDiff.diff() for the format.
+    def diff_scan(self, prev_scan, **kwargs):
+        return NvmeScanDiff(prev_scan, self.full_scan, **kwargs).diff()
 
     # Returns a dictionary object containing structured device information.
     # Elements of each dictionary item are similar and designed to allow lookup
@@ -94,6 +227,9 @@ class NvmeDeviceCollector(object):
     #
     def new_scan(self):
         timestamp = datetime.now().isoformat()
+        # unresponsive state is per scan, a controller that recovered since
+        # the last scan is queried again
+        self.tools_hlpr.reset_unresponsive()
         # scan host for devices as they exist upon instantiation
         #   o node_list  tells you which pcie devices have initialized successfully
         #   o block_list tells you which namespaces are attached (not much else)
@@ -133,12 +269,19 @@ class NvmeDeviceCollector(object):
             pcie_path = self.tools_hlpr.udevadm_get_path_by_name(dev_node)
             bdf       = pcie_path.bdf()
             id_ctrlr  = self.tools_hlpr.nvme_get_ctrl_identify(dev_node)
+            # a controller that timed out on admin commands is skipped for
+            # the rest of the scan and reported as unresponsive
+            if self.tools_hlpr.is_unresponsive(dev_node):
+                dev_state = 'unresponsive'
+            else:
+                dev_state = 'ok'
             dev_data  = {
                 'type':      'id_controller',
                 'bdf':       bdf,
                 'upstream':  pcie_path.upstream(),
                 'dev_node':  dev_node,
-                'cntlid':    id_ctrlr['cntlid'],
+                'state':     dev_state,
+                'cntlid':    id_ctrlr.get('cntlid', None),
                 'udev_path': pcie_path.udev_path(),
                 'id_ctrl':   id_ctrlr,
                 'list_ns':   ns_list
@@ -153,11 +296,42 @@ class NvmeDeviceCollector(object):
                     ns_lookup.update({ns_data['block_node']: dev_data})
         # save off full scan data for diff
         self.full_scan = {
+            'timestamp':   timestamp,
             'ctrl_list':   controller_list,
             'lu_bdf':      bdf_lookup,
             'lu_dev_node': node_lookup,
             'lu_ns':       ns_lookup
         }
+        if not (self.feature_ids is None):
+            self.feature_snapshot(self.feature_ids)
+        return self.full_scan
+
+    # Snapshot the current value of each feature id for every controller of
+    # the last scan, stored as dev_data['features'] = { '0x07': <value>, ... }.
+    # Features the controller doesn't support (per id_ctrl) are skipped, and
+    # so are unresponsive controllers.  All get-feature commands of all
+    # controllers run concurrently, max_workers at a time.
+    def feature_snapshot(self, feature_ids=None):
+        if feature_ids is None:
+            feature_ids = self.DEFAULT_FEATURES
+        requests = []
+        for dev_data in self.full_scan.get('ctrl_list', []):
+            dev_data.update({ 'features': {} })
+            if dev_data.get('state', 'ok') != 'ok':
+                continue
+            for feature_id in feature_ids:
+                check_fn = self.FEATURES.get(feature_id, (None, None))[1]
+                if (check_fn is None) or check_fn(dev_data['id_ctrl']):
+                    requests.append((dev_data, feature_id))
+
+        def get_feature(request):
+            return self.tools_hlpr.nvme_get_feature(request[0]['dev_node'], request[1])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            values = list(executor.map(get_feature, requests))
+        for (dev_data, feature_id), value in zip(requests, values):
+            if not (value is None):
+                dev_data['features'].update({ "0x{:02x}".format(feature_id): value })
         return self.full_scan
 
     # determine supported features; of interest are:
@@ -176,7 +350,51 @@ class NvmeDeviceCollector(object):
 # main execution routine IF this is run as a script
 if __name__ == '__main__':
     cli_args   = get_args()
-    if cli_args.diff_scan:
+    if cli_args.command == 'diff':
+        # offline diff of two saved scans, no devices are queried
+        diff_opts = {}
+        if not (cli_args.diff_ctrl_fields is None):
+            diff_opts.update({ 'ctrl_fields': cli_args.diff_ctrl_fields })
+        if not (cli_args.diff_ns_fields is None):
+            diff_opts.update({ 'ns_fields': cli_args.diff_ns_fields })
+        scan_diff = NvmeScanDiff(load_scan(cli_args.diff_files[0]),
+                                 load_scan(cli_args.diff_files[1]), **diff_opts)
+        print(scan_diff)
+    elif cli_args.command == 'store':
+        scan_store = NvmeScanStore(cli_args.store_db)
+        for scan_file in cli_args.store_files:
+            # older scan files have no timestamp, use the file time instead
+            file_time = datetime.fromtimestamp(os.path.getmtime(scan_file))
+            scan_data = load_scan(scan_file)
+            scan_id   = scan_store.add_scan(scan_data, host=cli_args.store_host,
+                                            timestamp=scan_data.get('timestamp', file_time))
+            if scan_id is None:
+                print("skipped {}, already stored".format(scan_file))
+            else:
+                print("stored {} as scan {}".format(scan_file, scan_id))
+        scan_store.close()
+    elif cli_args.command == 'export':
+        metrics = NvmeMetricsCollector(NvmeDeviceCollector(), cli_args.export_interval)
+        metrics.start()
+        server  = make_exporter(metrics, cli_args.export_port, cli_args.export_addr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        metrics.stop()
+    elif cli_args.command == 'query':
+        if cli_args.query_file is None:
+            scan_data = NvmeDeviceCollector().new_scan()
+        else:
+            scan_data = load_scan(cli_args.query_file)
+        for dev_data in cli_args.query.run(scan_data):
+            id_ctrl = dev_data.get('id_ctrl', {})
+            print("{} {} sn={} model={} fw={}".format(dev_data['dev_node'], dev_data['bdf'],
+                                                     id_ctrl.get('sn', '').strip(),
+                                                     id_ctrl.get('mn', '').strip(),
+                                                     id_ctrl.get('fr', '').strip()))
+    elif cli_args.diff_scan:
         # perform a DIFF scan from the input file; which means we don't scan
         # the current visible device list, we use the input file as a basis
         # for the device list, then update the information and taking note
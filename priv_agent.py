@@ -0,0 +1,236 @@
+import json
+import os
+import shlex
+import signal
+import struct
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Persistent privileged helper process.  One agent is started per host with
+# sudo (locally, or over a single ssh channel) and executes commands sent to
+# it as root, so individual commands don't pay for sudo / PAM session setup
+# and, remotely, for a new ssh channel each.
+#
+# Protocol: every message is a frame of a 4 byte big endian length followed
+# by a utf-8 json object.
+#   request:  { 'id': <int>, 'cmd': [ <arg>, ... ], 'cwd': <str>, 'timeout': <float> }
+#   response: { 'id': <int>, 'ret': <int>, 'out': <str>, 'err': <str> }
+# Requests are executed concurrently, responses are returned as commands
+# complete and matched to requests by id.  The agent sends a response with
+# id 0 once it is ready.
+#
+# The agent is started with a small bootstrap that reads the source of this
+# file as the first frame, so nothing has to be installed on the host.  This
+# module must only depend on the standard library for that reason.
+
+FRAME_HDR = struct.Struct('>I')
+
+# return codes in addition to the command's own, same as LinuxToolsHelper
+RET_EXCEPTION = 2
+RET_TIMEOUT   = 3
+
+BOOTSTRAP = ("import sys,struct;"
+             "n=struct.unpack('>I',sys.stdin.buffer.read(4))[0];"
+             "exec(compile(sys.stdin.buffer.read(n),'priv_agent','exec'),{'__name__':'__priv_agent__'})")
+
+
+def _read_exact(in_stream, length):
+    data = b''
+    while len(data) < length:
+        chunk = in_stream.read(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(in_stream):
+    header = _read_exact(in_stream, FRAME_HDR.size)
+    if header is None:
+        return None
+    payload = _read_exact(in_stream, FRAME_HDR.unpack(header)[0])
+    if payload is None:
+        return None
+    return json.loads(payload.decode('utf-8'))
+
+
+def write_frame(out_stream, obj):
+    payload = json.dumps(obj).encode('utf-8')
+    out_stream.write(FRAME_HDR.pack(len(payload)) + payload)
+    out_stream.flush()
+
+
+# agent side: execute one request, killing the process group on timeout
+def agent_exec(request):
+    try:
+        cmd_exec = subprocess.Popen(request['cmd'], cwd=request.get('cwd', None),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True,
+                                    start_new_session=True)
+        try:
+            stdout, stderr = cmd_exec.communicate(timeout=request.get('timeout', None))
+        except subprocess.TimeoutExpired:
+            os.killpg(cmd_exec.pid, signal.SIGKILL)
+            return { 'id': request['id'], 'ret': RET_TIMEOUT, 'out': "", 'err': "timeout" }
+        return { 'id': request['id'], 'ret': cmd_exec.poll(), 'out': stdout, 'err': stderr }
+    except Exception as exc:
+        return { 'id': request['id'], 'ret': RET_EXCEPTION, 'out': "{}".format(exc), 'err': "{}".format(exc) }
+
+
+def agent_main(in_stream, out_stream, max_workers=16):
+    write_lock = threading.Lock()
+
+    def run_request(request):
+        response = agent_exec(request)
+        with write_lock:
+            write_frame(out_stream, response)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with write_lock:
+            write_frame(out_stream, { 'id': 0, 'ret': 0, 'out': "{}".format(os.getpid()), 'err': "" })
+        while True:
+            request = read_frame(in_stream)
+            if request is None:
+                break
+            executor.submit(run_request, request)
+
+
+class PrivAgentClient(object):
+
+    # (optional) argument ssh_client:<SSHClient> start the agent on the remote
+    #            host over a single channel of this connection.
+    # (optional) argument use_sudo:<bool> start the agent with 'sudo -n', the
+    #            default; sudo must not prompt for a password.
+    # (optional) argument python:<str> python interpreter on the host.
+    #
+    def __init__(self, ssh_client=None, **kwargs):
+        self.ssh_client = ssh_client
+        self.use_sudo   = kwargs.get('use_sudo', True)
+        self.python     = kwargs.get('python', 'python3')
+        self.proc       = None
+        self.channel    = None
+        self._in_stream  = None
+        self._out_stream = None
+        self._reader     = None
+        self._next_id    = 1
+        self._pending    = {}
+        self._lock       = threading.Lock()
+        self._alive      = False
+
+    def agent_cmd(self):
+        agent_cmd = [ self.python, '-u', '-c', BOOTSTRAP ]
+        if self.use_sudo:
+            agent_cmd = [ 'sudo', '-n' ] + agent_cmd
+        return agent_cmd
+
+    def is_alive(self):
+        return self._alive
+
+    # start the agent and wait for it to report ready; returns False if the
+    # agent could not be started, e.g. sudo requires a password.
+    def start(self, timeout=10.0):
+        try:
+            if self.ssh_client is None:
+                self.proc = subprocess.Popen(self.agent_cmd(),
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             start_new_session=True)
+                self._out_stream = self.proc.stdin
+                self._in_stream  = self.proc.stdout
+            else:
+                self.channel = self.ssh_client.get_transport().open_session()
+                self.channel.exec_command(" ".join([ shlex.quote(arg) for arg in self.agent_cmd() ]))
+                self._out_stream = self.channel.makefile('wb')
+                self._in_stream  = self.channel.makefile('rb')
+        except Exception:
+            self.close()
+            return False
+        with open(os.path.abspath(__file__), 'rb') as src_file:
+            agent_src = src_file.read()
+        ready = threading.Event()
+        self._pending.update({ 0: { 'event': ready, 'response': None } })
+        self._alive  = True
+        self._reader = threading.Thread(target=self._read_responses, name='priv-agent-reader', daemon=True)
+        self._reader.start()
+        try:
+            self._out_stream.write(FRAME_HDR.pack(len(agent_src)) + agent_src)
+            self._out_stream.flush()
+        except (OSError, ValueError):
+            pass
+        if (not ready.wait(timeout)) or (self._pending.pop(0, {}).get('response', None) is None):
+            self.close()
+            return False
+        return True
+
+    def _read_responses(self):
+        while True:
+            try:
+                response = read_frame(self._in_stream)
+            except (OSError, ValueError):
+                response = None
+            if response is None:
+                break
+            with self._lock:
+                pending = self._pending.get(response['id'], None)
+            if not (pending is None):
+                pending['response'] = response
+                pending['event'].set()
+        # agent is gone, fail everything still waiting
+        self._alive = False
+        with self._lock:
+            for pending in self._pending.values():
+                pending['event'].set()
+
+    # execute a command through the agent, may be called from many threads
+    # concurrently.  Returns the same ret_code, stdout tuple as the
+    # LinuxToolsHelper exec routines, plus stderr.
+    def exec(self, cmd_list, cwd_opt=None, timeout=None):
+        if not self._alive:
+            return RET_EXCEPTION, "", "agent not running"
+        event = threading.Event()
+        with self._lock:
+            req_id = self._next_id
+            self._next_id += 1
+            self._pending.update({ req_id: { 'event': event, 'response': None } })
+            try:
+                write_frame(self._out_stream, { 'id': req_id, 'cmd': cmd_list, 'cwd': cwd_opt, 'timeout': timeout })
+            except (OSError, ValueError) as exc:
+                self._pending.pop(req_id)
+                return RET_EXCEPTION, "", "{}".format(exc)
+        # the agent enforces the timeout, this only guards against a hung agent
+        wait_time = None
+        if not (timeout is None):
+            wait_time = timeout + 5.0
+        event.wait(wait_time)
+        with self._lock:
+            response = self._pending.pop(req_id)['response']
+        if response is None:
+            if self._alive:
+                return RET_TIMEOUT, "", "no response from agent"
+            return RET_EXCEPTION, "", "agent exited"
+        return response['ret'], response['out'], response['err']
+
+    def close(self):
+        self._alive = False
+        for stream in [ self._out_stream, self._in_stream ]:
+            if not (stream is None):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        if not (self.proc is None):
+            try:
+                self.proc.wait(timeout=5.0)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+            self.proc = None
+        if not (self.channel is None):
+            self.channel.close()
+            self.channel = None
+
+
+if __name__ == '__priv_agent__':
+    agent_main(sys.stdin.buffer, sys.stdout.buffer)
@@ -0,0 +1,151 @@
+import json
+
+
+# load a scan saved as json (the output of NvmeDeviceCollector.new_scan)
+def load_scan(file_path):
+    with open(file_path, 'r') as scan_file:
+        return json.load(scan_file)
+
+
+class NvmeScanDiff(object):
+
+    # fields compared for each controller and namespace, each maps the field
+    # name in the diff output to a getter on the scan data item.  Only these
+    # fields are compared, everything else in id_ctrl / id_ns is ignored.
+    CTRL_FIELDS = {
+        'fw':       lambda ctrl: ctrl.get('id_ctrl', {}).get('fr', None),
+        'capacity': lambda ctrl: ctrl.get('id_ctrl', {}).get('tnvmcap', None),
+        'bdf':      lambda ctrl: ctrl.get('bdf', None),
+        'dev_node': lambda ctrl: ctrl.get('dev_node', None),
+        'state':    lambda ctrl: ctrl.get('state', 'ok')
+    }
+    NS_FIELDS = {
+        'nsze':   lambda ns: (ns.get('id_ns') or {}).get('nsze', None)
+    }
+
+    # (optional) argument ctrl_fields:<list> names from CTRL_FIELDS to compare
+    # (optional) argument ns_fields:<list>   names from NS_FIELDS to compare
+    #
+    def __init__(self, old_scan, new_scan, **kwargs):
+        self.old_scan    = old_scan
+        self.new_scan    = new_scan
+        self.ctrl_fields = kwargs.get('ctrl_fields', list(self.CTRL_FIELDS.keys()))
+        self.ns_fields   = kwargs.get('ns_fields', list(self.NS_FIELDS.keys()))
+        for field in self.ctrl_fields:
+            if not (field in self.CTRL_FIELDS):
+                raise ValueError("unknown controller diff field: {}".format(field))
+        for field in self.ns_fields:
+            if not (field in self.NS_FIELDS):
+                raise ValueError("unknown namespace diff field: {}".format(field))
+        self.changes = None
+
+    # controllers are keyed by (serial, cntlid); dual port drives report the
+    # same serial on each port with a different cntlid.  A controller that
+    # could not be identified has no serial, fall back to its BDF.
+    @staticmethod
+    def ctrl_key(dev_data):
+        serial = dev_data.get('id_ctrl', {}).get('sn', None)
+        if serial is None:
+            return 'bdf', dev_data.get('bdf', None)
+        return serial.strip(), dev_data.get('cntlid', None)
+
+    # returns a dictionary of ctrl_key: dev_data, a dictionary of
+    # (serial, nsid): ns_data for all namespaces reported by the controllers,
+    # and the set of serials whose namespace state is unknown because their
+    # controller is not responding.  Namespaces of a controller without a
+    # serial can't be attributed to a drive and are left out.
+    @classmethod
+    def index_scan(cls, full_scan):
+        ctrl_index = {}
+        ns_index   = {}
+        ns_unknown = set()
+        for dev_data in full_scan.get('ctrl_list', []):
+            ctrl_key = cls.ctrl_key(dev_data)
+            ctrl_index.update({ ctrl_key: dev_data })
+            if dev_data.get('state', 'ok') != 'ok':
+                ns_unknown.add(ctrl_key[0])
+                continue
+            if ctrl_key[0] == 'bdf':
+                continue
+            for ns_item in (dev_data.get('list_ns') or []):
+                ns_data = {
+                    'id_ns':  ns_item.get('id_ns', None)
+                }
+                ns_index.update({ (ctrl_key[0], ns_item['ns_id']): ns_data })
+        return ctrl_index, ns_index, ns_unknown
+
+    # a controller that failed identify has no serial in one scan, align it
+    # with the controller at the same BDF in the other scan.
+    @staticmethod
+    def _align_by_bdf(ctrl_index, ns_unknown, other_index):
+        bdf_keys = dict([ (dev_data.get('bdf', None), ctrl_key) for ctrl_key, dev_data in other_index.items() ])
+        for ctrl_key in [ ctrl_key for ctrl_key in ctrl_index.keys() if ctrl_key[0] == 'bdf' ]:
+            other_key = bdf_keys.get(ctrl_key[1], None)
+            if (other_key is None) or (other_key in ctrl_index):
+                continue
+            ctrl_index.update({ other_key: ctrl_index.pop(ctrl_key) })
+            ns_unknown.add(other_key[0])
+
+    @staticmethod
+    def _diff_items(obj_type, old_index, new_index, fields, getters):
+        changes = []
+        for item_key, new_item in new_index.items():
+            old_item = old_index.get(item_key, None)
+            if old_item is None:
+                changes.append({ 'change': 'added', 'object': obj_type, 'key': item_key,
+                                 'field': None, 'old': None, 'new': None })
+                continue
+            for field in fields:
+                old_value = getters[field](old_item)
+                new_value = getters[field](new_item)
+                if old_value != new_value:
+                    changes.append({ 'change': 'modified', 'object': obj_type, 'key': item_key,
+                                     'field': field, 'old': old_value, 'new': new_value })
+        for item_key in old_index.keys():
+            if not (item_key in new_index):
+                changes.append({ 'change': 'removed', 'object': obj_type, 'key': item_key,
+                                 'field': None, 'old': None, 'new': None })
+        return changes
+
+    # Returns a list of change records, one per added or removed controller /
+    # namespace and one per modified field:
+    #   { 'change': 'added' | 'removed' | 'modified',
+    #     'object': 'controller' | 'namespace',
+    #     'key':    (serial, cntlid) | (serial, nsid),
+    #     'field':  <field name> (modified only),
+    #     'old':    <old value>, 'new': <new value> }
+    #
+    def diff(self):
+        old_ctrls, old_ns, old_unknown = self.index_scan(self.old_scan)
+        new_ctrls, new_ns, new_unknown = self.index_scan(self.new_scan)
+        self._align_by_bdf(new_ctrls, new_unknown, old_ctrls)
+        self._align_by_bdf(old_ctrls, old_unknown, new_ctrls)
+        self.changes = self._diff_items('controller', old_ctrls, new_ctrls,
+                                        self.ctrl_fields, self.CTRL_FIELDS)
+        # namespaces of controllers that are gone are implied by the removed
+        # controller, only report namespaces of drives present in both scans
+        # as removed, e.g. a namespace drop.  Namespaces of a controller that
+        # is not responding in either scan are unknown rather than dropped.
+        ns_unknown  = old_unknown | new_unknown
+        old_serials = set([ ctrl_key[0] for ctrl_key in old_ctrls.keys() ]) - ns_unknown
+        new_serials = set([ ctrl_key[0] for ctrl_key in new_ctrls.keys() ]) - ns_unknown
+        old_ns = dict([ (ns_key, ns_data) for ns_key, ns_data in old_ns.items() if ns_key[0] in new_serials ])
+        new_ns = dict([ (ns_key, ns_data) for ns_key, ns_data in new_ns.items() if ns_key[0] in old_serials ])
+        self.changes += self._diff_items('namespace', old_ns, new_ns,
+                                         self.ns_fields, self.NS_FIELDS)
+        return self.changes
+
+    @staticmethod
+    def format_change(change):
+        if change['object'] == 'controller':
+            key_str = "controller sn={} cntlid={}".format(change['key'][0], change['key'][1])
+        else:
+            key_str = "namespace sn={} nsid={}".format(change['key'][0], change['key'][1])
+        if change['change'] == 'modified':
+            return "{} {}: {} -> {}".format(key_str, change['field'], change['old'], change['new'])
+        return "{} {}".format(key_str, change['change'])
+
+    def __str__(self):
+        if self.changes is None:
+            self.diff()
+        return "\n".join([ self.format_change(change) for change in self.changes ])
@@ -0,0 +1,201 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class NvmeMetricsCollector(object):
+
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    # metric name: help text, all metrics are gauges.  There is no per
+    # namespace attach metric, list-ns only reports attached namespaces so it
+    # would always be 1; nvme_namespace_count drops when one is detached.
+    METRICS = {
+        'nvme_controller_info':         'Controller identity, value is always 1.',
+        'nvme_controller_responsive':   '1 if the controller answered admin commands during the last scan.',
+        'nvme_namespace_count':         'Number of active namespaces reported by the controller.',
+        'nvme_pcie_link_width':         'Current PCIe link width (lanes).',
+        'nvme_pcie_link_width_max':     'Maximum PCIe link width (lanes).',
+        'nvme_temperature_celsius':     'Composite temperature reported in the SMART log.',
+        'nvme_critical_warning':        'Critical warning bits reported in the SMART log.',
+        'nvme_percent_used':            'Percentage of the endurance used reported in the SMART log.',
+        'nvme_media_errors':            'Media and data integrity errors reported in the SMART log.',
+        'nvme_error_log_entries':       'Number of error log entries reported in the SMART log.',
+        'nvme_scan_timestamp_seconds':  'Unix time the last successful scan completed.',
+        'nvme_scan_duration_seconds':   'Duration of the last successful scan.',
+        'nvme_scan_errors':             'Number of background scans that failed.'
+    }
+
+    # Scans run in a background thread every interval seconds, each scan is
+    # rendered once into a cached snapshot; scrapes only return the snapshot
+    # so they never issue NVMe commands, no matter how many scrapers there
+    # are or how many drives are installed.
+    #
+    #   collector: NvmeDeviceCollector used for scans
+    #   interval:  seconds between the start of two scans
+    #
+    def __init__(self, collector, interval=60.0):
+        self.collector   = collector
+        self.interval    = interval
+        self.scan_errors = 0
+        # full_scan, health, scan_meta of the last good scan, re-rendered with
+        # the new error count when a scan fails
+        self._last_scan  = ({}, {}, None)
+        self._snapshot   = self.render(*self._last_scan)
+        self._lock       = threading.Lock()
+        self._stop       = threading.Event()
+        self._thread     = None
+
+    @staticmethod
+    def _escape(value):
+        return "{}".format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    # missing values (e.g. no cntlid of an unresponsive controller) are empty
+    @staticmethod
+    def _label(value):
+        if value is None:
+            return ''
+        return value
+
+    @classmethod
+    def _sample(cls, name, labels, value):
+        if len(labels) == 0:
+            return "{} {}".format(name, value)
+        label_str = ",".join([ '{}="{}"'.format(key, cls._escape(val)) for key, val in labels.items() ])
+        return "{}{{{}}} {}".format(name, label_str, value)
+
+    # query health data that isn't part of the scan, per controller dev node
+    def collect_health(self, full_scan):
+        tools_hlpr = self.collector.tools_hlpr
+        health     = {}
+        for dev_data in full_scan.get('ctrl_list', []):
+            if dev_data.get('state', 'ok') != 'ok':
+                continue
+            health.update({ dev_data['dev_node']: {
+                'link':  tools_hlpr.pcie_get_link_status(dev_data['bdf']),
+                'smart': tools_hlpr.nvme_get_smart_log(dev_data['dev_node'])
+            } })
+        return health
+
+    # render a scan and its health data in OpenMetrics text format
+    def render(self, full_scan, health, scan_meta=None):
+        samples = dict([ (name, []) for name in self.METRICS.keys() ])
+        for dev_data in full_scan.get('ctrl_list', []):
+            id_ctrl = dev_data.get('id_ctrl') or {}
+            labels  = {
+                'serial':   id_ctrl.get('sn', '').strip(),
+                'cntlid':   self._label(dev_data.get('cntlid', None)),
+                'bdf':      self._label(dev_data.get('bdf', None)),
+                'dev_node': self._label(dev_data.get('dev_node', None))
+            }
+            info_labels = dict(labels)
+            info_labels.update({ 'model': id_ctrl.get('mn', '').strip(), 'fw': id_ctrl.get('fr', '').strip() })
+            samples['nvme_controller_info'].append(self._sample('nvme_controller_info', info_labels, 1))
+            responsive = int(dev_data.get('state', 'ok') == 'ok')
+            samples['nvme_controller_responsive'].append(self._sample('nvme_controller_responsive', labels, responsive))
+            if not responsive:
+                continue
+            ns_list = dev_data.get('list_ns') or []
+            samples['nvme_namespace_count'].append(self._sample('nvme_namespace_count', labels, len(ns_list)))
+            dev_health = health.get(dev_data['dev_node'], {})
+            link = dev_health.get('link', None)
+            if not (link is None):
+                samples['nvme_pcie_link_width'].append(
+                    self._sample('nvme_pcie_link_width', labels, link['current_link_width']))
+                samples['nvme_pcie_link_width_max'].append(
+                    self._sample('nvme_pcie_link_width_max', labels, link['max_link_width']))
+            smart = dev_health.get('smart', None) or {}
+            if 'temperature' in smart:
+                # reported in kelvin
+                samples['nvme_temperature_celsius'].append(
+                    self._sample('nvme_temperature_celsius', labels, smart['temperature'] - 273))
+            for smart_key, name in [ ('critical_warning',    'nvme_critical_warning'),
+                                     ('percent_used',        'nvme_percent_used'),
+                                     ('media_errors',        'nvme_media_errors'),
+                                     ('num_err_log_entries', 'nvme_error_log_entries') ]:
+                if smart_key in smart:
+                    samples[name].append(self._sample(name, labels, smart[smart_key]))
+        if not (scan_meta is None):
+            samples['nvme_scan_timestamp_seconds'].append(
+                self._sample('nvme_scan_timestamp_seconds', {}, scan_meta['timestamp']))
+            samples['nvme_scan_duration_seconds'].append(
+                self._sample('nvme_scan_duration_seconds', {}, scan_meta['duration']))
+        samples['nvme_scan_errors'].append(self._sample('nvme_scan_errors', {}, self.scan_errors))
+        out_lines = []
+        for name, help_text in self.METRICS.items():
+            if len(samples[name]) == 0:
+                continue
+            out_lines.append("# TYPE {} gauge".format(name))
+            out_lines.append("# HELP {} {}".format(name, help_text))
+            out_lines += samples[name]
+        out_lines.append("# EOF\n")
+        return "\n".join(out_lines).encode('utf-8')
+
+    # run one scan and swap in the new snapshot; on failure the data of the
+    # previous scan is kept and rendered again with the increased error count.
+    def refresh(self):
+        start_time = time.time()
+        try:
+            full_scan = self.collector.new_scan()
+            health    = self.collect_health(full_scan)
+            end_time  = time.time()
+            scan_meta = { 'timestamp': end_time, 'duration': end_time - start_time }
+            snapshot  = self.render(full_scan, health, scan_meta)
+            self._last_scan = (full_scan, health, scan_meta)
+            ret_val   = True
+        except Exception as exc:
+            self.collector.tools_hlpr.log('ERROR', "(EXCEPTION) background scan failed:\n{}".format(exc))
+            self.scan_errors += 1
+            snapshot  = self.render(*self._last_scan)
+            ret_val   = False
+        with self._lock:
+            self._snapshot = snapshot
+        return ret_val
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    # the first scan runs before returning, so scrapes always get data
+    def start(self):
+        self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='nvme-metrics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if not (self._thread is None):
+            self._thread.join()
+            self._thread = None
+
+
+class NvmeMetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.snapshot()
+        self.send_response(200)
+        self.send_header('Content-Type', self.server.metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', "{}".format(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # scrapes are frequent, don't log every request to stderr
+    def log_message(self, format, *args):
+        pass
+
+
+# create the http server for the metrics collector, call serve_forever() on
+# the returned server to serve /metrics.
+def make_exporter(metrics, port=9998, addr='127.0.0.1'):
+    server = ThreadingHTTPServer((addr, port), NvmeMetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    return server
@@ -0,0 +1,239 @@
+import re
+from bisect import bisect_left, bisect_right
+
+# Small query language over scan data (live new_scan() output or a saved
+# scan file), evaluated per controller, e.g.:
+#
+#   model~"7450" and fw<"E2MU200" and root=0000:00:01.1
+#   (node=/dev/nvme0 or node=/dev/nvme1) and not state=unresponsive
+#
+# Comparisons are <field><op><value> with op one of = != < <= > >= ~ (regex
+# search); values are bare words or double quoted strings.  Comparisons are
+# combined with 'and', 'or', 'not' and parentheses.  Fields are the ones in
+# ScanIndex.FIELDS, any other name is looked up in id_ctrl (e.g. vid=4932).
+
+TOKEN_RE = re.compile(r'\s*(?:(?P<paren>[()])|'
+                      r'(?P<cmp>(?P<field>[A-Za-z_][A-Za-z0-9_]*)\s*(?P<op>!=|<=|>=|=|<|>|~)\s*'
+                      r'(?:"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<bare>[^\s()"]+)))|'
+                      r'(?P<word>[A-Za-z]+))')
+
+
+def _strip(value):
+    if value is None:
+        return None
+    return value.strip()
+
+
+class ScanIndex(object):
+
+    # field name: getter on a controller item (dev_data), indexed fields are
+    # kept in value -> rows dictionaries, everything else is evaluated by a
+    # scan over the controllers.
+    FIELDS = {
+        'serial':   lambda dev: _strip(dev.get('id_ctrl', {}).get('sn', None)),
+        'model':    lambda dev: _strip(dev.get('id_ctrl', {}).get('mn', None)),
+        'fw':       lambda dev: _strip(dev.get('id_ctrl', {}).get('fr', None)),
+        'bdf':      lambda dev: dev.get('bdf', None),
+        'node':     lambda dev: dev.get('dev_node', None),
+        'upstream': lambda dev: dev.get('upstream', None),
+        'root':     lambda dev: ScanIndex.udev_root(dev.get('udev_path', None)),
+        'cntlid':   lambda dev: dev.get('cntlid', None),
+        'state':    lambda dev: dev.get('state', 'ok'),
+        'capacity': lambda dev: dev.get('id_ctrl', {}).get('tnvmcap', None),
+        'ns_count': lambda dev: len(dev.get('list_ns') or [])
+    }
+    INDEXED = [ 'serial', 'model', 'fw', 'bdf', 'node', 'upstream', 'root', 'cntlid', 'state' ]
+
+    # lu_bdf / lu_dev_node of a scan are not used directly, a scan loaded
+    # from file has separate copies of the controller items in them; the
+    # same lookups are rebuilt here as row indexes instead.
+    def __init__(self, full_scan):
+        self.ctrl_list = full_scan.get('ctrl_list', [])
+        self.all_rows  = frozenset(range(len(self.ctrl_list)))
+        self.indexes   = dict([ (field, {}) for field in self.INDEXED ])
+        for row, dev_data in enumerate(self.ctrl_list):
+            for field in self.INDEXED:
+                value = self.FIELDS[field](dev_data)
+                if value is None:
+                    continue
+                self.indexes[field].setdefault(value, set()).add(row)
+        # sorted distinct values for range lookups
+        self.sorted_keys = dict([ (field, sorted(index.keys())) for field, index in self.indexes.items() ])
+
+    # root port BDF from the udev path, the first device below the host
+    # bridge (pciDDDD:BB) e.g. 0000:00:01.1 for:
+    #   /devices/pci0000:00/0000:00:01.1/0000:02:00.0/nvme/nvme0
+    @staticmethod
+    def udev_root(udev_path):
+        if udev_path is None:
+            return None
+        path_split = udev_path.split('/')
+        if len(path_split) <= 3:
+            return None
+        return path_split[3]
+
+    def field_value(self, row, field):
+        dev_data = self.ctrl_list[row]
+        if field in self.FIELDS:
+            return self.FIELDS[field](dev_data)
+        return dev_data.get('id_ctrl', {}).get(field, None)
+
+    @staticmethod
+    def _compare(value, op, ref):
+        if value is None:
+            return False
+        if op == '~':
+            return ref.search("{}".format(value)) is not None
+        try:
+            if op == '=':
+                return value == ref
+            if op == '!=':
+                return value != ref
+            if op == '<':
+                return value < ref
+            if op == '<=':
+                return value <= ref
+            if op == '>':
+                return value > ref
+            return value >= ref
+        except TypeError:
+            return False
+
+    def _typed_ref(self, field, value):
+        if field in [ 'cntlid', 'capacity', 'ns_count' ] or not (field in self.FIELDS):
+            try:
+                return int(value, 0)
+            except ValueError:
+                pass
+        return value
+
+    # returns the set of rows matching a single comparison, the value of a
+    # '~' comparison is a pattern string or an already compiled pattern
+    def lookup(self, field, op, value):
+        if op == '~':
+            ref = re.compile(value)
+        else:
+            ref = self._typed_ref(field, value)
+        index = self.indexes.get(field, None)
+        if index is None:
+            # unindexed field, scan all controllers
+            return set([ row for row in range(len(self.ctrl_list))
+                         if self._compare(self.field_value(row, field), op, ref) ])
+        if op == '=':
+            return set(index.get(ref, set()))
+        keys = self.sorted_keys[field]
+        if op in [ '<', '<=', '>', '>=' ]:
+            try:
+                if op == '<':
+                    keys = keys[:bisect_left(keys, ref)]
+                elif op == '<=':
+                    keys = keys[:bisect_right(keys, ref)]
+                elif op == '>':
+                    keys = keys[bisect_right(keys, ref):]
+                else:
+                    keys = keys[bisect_left(keys, ref):]
+            except TypeError:
+                return set()
+        else:
+            # '!=' and '~' are evaluated over the distinct values only
+            keys = [ key for key in keys if self._compare(key, op, ref) ]
+        rows = set()
+        for key in keys:
+            rows |= index[key]
+        return rows
+
+
+class ScanQuery(object):
+
+    def __init__(self, query_str):
+        self.query_str = query_str
+        self.tokens    = self._tokenize(query_str)
+        self._pos      = 0
+        self.tree      = self._parse_or()
+        if self._pos != len(self.tokens):
+            raise ValueError("query syntax error at '{}'".format(self.tokens[self._pos][1]))
+
+    @staticmethod
+    def _tokenize(query_str):
+        tokens = []
+        pos    = 0
+        query_str = query_str.rstrip()
+        while pos < len(query_str):
+            match = TOKEN_RE.match(query_str, pos)
+            if match is None:
+                raise ValueError("query syntax error at '{}'".format(query_str[pos:].strip()))
+            if match.group('paren'):
+                tokens.append(('paren', match.group('paren')))
+            elif match.group('cmp'):
+                value = match.group('bare')
+                if value is None:
+                    value = re.sub(r'\\(.)', r'\1', match.group('quoted'))
+                if match.group('op') == '~':
+                    try:
+                        value = re.compile(value)
+                    except re.error as exc:
+                        raise ValueError("query syntax error, invalid regex '{}': {}".format(value, exc))
+                tokens.append(('cmp', (match.group('field'), match.group('op'), value)))
+            else:
+                word = match.group('word').lower()
+                if not (word in [ 'and', 'or', 'not' ]):
+                    raise ValueError("query syntax error at '{}'".format(match.group('word')))
+                tokens.append(('word', word))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self.tokens):
+            return self.tokens[self._pos]
+        return (None, None)
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek() == ('word', 'or'):
+            self._pos += 1
+            node = ('or', node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek() == ('word', 'and'):
+            self._pos += 1
+            node = ('and', node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        token = self._peek()
+        self._pos += 1
+        if token == ('word', 'not'):
+            return ('not', self._parse_not())
+        if token == ('paren', '('):
+            node = self._parse_or()
+            if self._peek() != ('paren', ')'):
+                raise ValueError("query syntax error, missing ')'")
+            self._pos += 1
+            return node
+        if token[0] == 'cmp':
+            return ('cmp', token[1])
+        if token[0] is None:
+            raise ValueError("query syntax error, unexpected end of query")
+        raise ValueError("query syntax error at '{}'".format(token[1]))
+
+    def _eval(self, node, scan_index):
+        if node[0] == 'cmp':
+            return scan_index.lookup(*node[1])
+        if node[0] == 'not':
+            return scan_index.all_rows - self._eval(node[1], scan_index)
+        left = self._eval(node[1], scan_index)
+        if (node[0] == 'and') and (len(left) == 0):
+            return left
+        right = self._eval(node[2], scan_index)
+        if node[0] == 'and':
+            return left & right
+        return left | right
+
+    # returns the matching controller items, in scan order; scan is either a
+    # full_scan dictionary or a ScanIndex to reuse for many queries.
+    def run(self, scan):
+        if not isinstance(scan, ScanIndex):
+            scan = ScanIndex(scan)
+        return [ scan.ctrl_list[row] for row in sorted(self._eval(self.tree, scan)) ]
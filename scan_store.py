@@ -0,0 +1,229 @@
+import hashlib
+import json
+import socket
+import sqlite3
+from datetime import datetime
+from scan_diff import NvmeScanDiff
+
+
+class NvmeScanStore(object):
+
+    # Scans are stored as normalized rows, one per controller and namespace.
+    # Identify payloads are stored once per unique content (keyed by hash),
+    # namespace attach / drop events are computed against the previous scan
+    # of the same host when a scan is added, so change queries never have to
+    # load old scans.  A host has at most one scan per timestamp; a scan added
+    # out of order also recomputes the events of the next scan of the host.
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS scans (
+               scan_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+               host      TEXT NOT NULL,
+               timestamp TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS payloads (
+               hash      TEXT PRIMARY KEY,
+               payload   TEXT NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS controllers (
+               scan_id      INTEGER NOT NULL REFERENCES scans(scan_id),
+               serial       TEXT,
+               cntlid       INTEGER,
+               model        TEXT,
+               fw           TEXT,
+               bdf          TEXT,
+               upstream     TEXT,
+               dev_node     TEXT,
+               state        TEXT,
+               id_ctrl_hash TEXT REFERENCES payloads(hash))""",
+        """CREATE TABLE IF NOT EXISTS namespaces (
+               scan_id    INTEGER NOT NULL REFERENCES scans(scan_id),
+               serial     TEXT NOT NULL,
+               nsid       INTEGER NOT NULL,
+               nsze       INTEGER,
+               id_ns_hash TEXT REFERENCES payloads(hash))""",
+        """CREATE TABLE IF NOT EXISTS ns_events (
+               scan_id   INTEGER NOT NULL REFERENCES scans(scan_id),
+               host      TEXT NOT NULL,
+               timestamp TEXT NOT NULL,
+               serial    TEXT NOT NULL,
+               nsid      INTEGER NOT NULL,
+               event     TEXT NOT NULL)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_scans_host_ts ON scans (host, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_scans_ts ON scans (timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_ctrl_serial ON controllers (serial, scan_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ctrl_bdf ON controllers (bdf, scan_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ctrl_scan ON controllers (scan_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ns_scan ON namespaces (scan_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ns_serial ON namespaces (serial, nsid)",
+        "CREATE INDEX IF NOT EXISTS ix_events_ts ON ns_events (event, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_events_serial ON ns_events (serial, timestamp)"
+    ]
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn    = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            for sql_str in self.SCHEMA:
+                self.conn.execute(sql_str)
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    # store a payload (id_ctrl / id_ns dict) once, returns its hash
+    def _add_payload(self, payload):
+        if not payload:
+            return None
+        payload_str  = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+        payload_hash = hashlib.sha1(payload_str.encode('utf-8')).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO payloads (hash, payload) VALUES (?, ?)",
+                          (payload_hash, payload_str))
+        return payload_hash
+
+    def get_payload(self, payload_hash):
+        row = self.conn.execute("SELECT payload FROM payloads WHERE hash = ?",
+                                (payload_hash,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row['payload'])
+
+    @staticmethod
+    def _ts_str(timestamp):
+        if isinstance(timestamp, datetime):
+            return timestamp.isoformat()
+        return timestamp
+
+    def _prev_scan_id(self, host, timestamp):
+        row = self.conn.execute("SELECT scan_id FROM scans WHERE host = ? AND timestamp < ? "
+                                "ORDER BY timestamp DESC LIMIT 1", (host, timestamp)).fetchone()
+        if row is None:
+            return None
+        return row['scan_id']
+
+    def _next_scan(self, host, timestamp):
+        return self.conn.execute("SELECT scan_id, timestamp FROM scans WHERE host = ? AND timestamp > ? "
+                                 "ORDER BY timestamp LIMIT 1", (host, timestamp)).fetchone()
+
+    # add a full_scan (see NvmeDeviceCollector.new_scan) to the store.
+    #   host:      defaults to the local host name
+    #   timestamp: defaults to the scan 'timestamp', or now if it has none
+    # returns the scan_id of the new scan, or None if the host already has a
+    # scan with the same timestamp (e.g. the same scan file imported twice).
+    def add_scan(self, full_scan, host=None, timestamp=None):
+        if host is None:
+            host = socket.gethostname()
+        if timestamp is None:
+            timestamp = full_scan.get('timestamp', datetime.now().isoformat())
+        timestamp = self._ts_str(timestamp)
+        ctrl_index, ns_index = NvmeScanDiff.index_scan(full_scan)[:2]
+        with self.conn:
+            row = self.conn.execute("SELECT scan_id FROM scans WHERE host = ? AND timestamp = ?",
+                                    (host, timestamp)).fetchone()
+            if not (row is None):
+                return None
+            prev_id = self._prev_scan_id(host, timestamp)
+            cursor  = self.conn.execute("INSERT INTO scans (host, timestamp) VALUES (?, ?)",
+                                        (host, timestamp))
+            scan_id = cursor.lastrowid
+            ctrl_rows = []
+            for ctrl_key, dev_data in ctrl_index.items():
+                id_ctrl = dev_data.get('id_ctrl') or {}
+                ctrl_rows.append((scan_id,
+                                  id_ctrl.get('sn', '').strip() or None,
+                                  dev_data.get('cntlid', None),
+                                  id_ctrl.get('mn', '').strip() or None,
+                                  id_ctrl.get('fr', '').strip() or None,
+                                  dev_data.get('bdf', None),
+                                  dev_data.get('upstream', None),
+                                  dev_data.get('dev_node', None),
+                                  dev_data.get('state', 'ok'),
+                                  self._add_payload(id_ctrl)))
+            self.conn.executemany("INSERT INTO controllers (scan_id, serial, cntlid, model, fw, bdf, "
+                                  "upstream, dev_node, state, id_ctrl_hash) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ctrl_rows)
+            # namespaces are only stored for controllers with a serial, the
+            # same ones events are computed for (see _scan_ns)
+            ctrl_serials = set([ ctrl_row[1] for ctrl_row in ctrl_rows if not (ctrl_row[1] is None) ])
+            ns_rows = []
+            for (serial, nsid), ns_data in ns_index.items():
+                if not (serial in ctrl_serials):
+                    continue
+                id_ns = ns_data.get('id_ns') or {}
+                ns_rows.append((scan_id, serial, nsid, id_ns.get('nsze', None), self._add_payload(id_ns)))
+            self.conn.executemany("INSERT INTO namespaces (scan_id, serial, nsid, nsze, id_ns_hash) "
+                                  "VALUES (?, ?, ?, ?, ?)", ns_rows)
+            if not (prev_id is None):
+                self._add_ns_events(scan_id, host, timestamp, prev_id)
+            # the next scan was compared against an older scan so far
+            next_scan = self._next_scan(host, timestamp)
+            if not (next_scan is None):
+                self.conn.execute("DELETE FROM ns_events WHERE scan_id = ?", (next_scan['scan_id'],))
+                self._add_ns_events(next_scan['scan_id'], host, next_scan['timestamp'], scan_id)
+        return scan_id
+
+    # serials whose namespaces are known in a scan, and its (serial, nsid)
+    # set; namespaces of a drive with an unresponsive controller are unknown.
+    def _scan_ns(self, scan_id):
+        ok_serials  = set()
+        bad_serials = set()
+        for row in self.conn.execute("SELECT serial, state FROM controllers WHERE scan_id = ?", (scan_id,)):
+            if row['serial'] is None:
+                continue
+            if row['state'] == 'ok':
+                ok_serials.add(row['serial'])
+            else:
+                bad_serials.add(row['serial'])
+        ns_keys = set([ (row['serial'], row['nsid']) for row in self.conn.execute(
+                        "SELECT serial, nsid FROM namespaces WHERE scan_id = ?", (scan_id,)) ])
+        return ok_serials - bad_serials, ns_keys
+
+    # record namespace 'attach' / 'drop' events against the previous scan of
+    # the host; only for drives present and responding in both scans.
+    def _add_ns_events(self, scan_id, host, timestamp, prev_id):
+        prev_serials, prev_ns = self._scan_ns(prev_id)
+        cur_serials, cur_ns   = self._scan_ns(scan_id)
+        event_rows = []
+        for serial, nsid in prev_ns - cur_ns:
+            if serial in cur_serials:
+                event_rows.append((scan_id, host, timestamp, serial, nsid, 'drop'))
+        for serial, nsid in cur_ns - prev_ns:
+            if serial in prev_serials:
+                event_rows.append((scan_id, host, timestamp, serial, nsid, 'attach'))
+        self.conn.executemany("INSERT INTO ns_events (scan_id, host, timestamp, serial, nsid, event) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", event_rows)
+
+    # Returns a list of dicts, one per scan the serial was seen in, oldest
+    # first: host, timestamp, cntlid, model, fw, bdf, upstream, dev_node, state
+    def serial_history(self, serial):
+        rows = self.conn.execute("SELECT s.host, s.timestamp, c.cntlid, c.model, c.fw, c.bdf, "
+                                 "c.upstream, c.dev_node, c.state FROM controllers c "
+                                 "JOIN scans s ON s.scan_id = c.scan_id "
+                                 "WHERE c.serial = ? ORDER BY s.timestamp", (serial,))
+        return [ dict(row) for row in rows ]
+
+    # Returns a list of dicts, one per scan a controller was seen at the BDF
+    def bdf_history(self, bdf, host=None):
+        sql_str = ("SELECT s.host, s.timestamp, c.serial, c.cntlid, c.model, c.fw, c.dev_node, c.state "
+                   "FROM controllers c JOIN scans s ON s.scan_id = c.scan_id WHERE c.bdf = ?")
+        params  = [ bdf ]
+        if not (host is None):
+            sql_str += " AND s.host = ?"
+            params.append(host)
+        rows = self.conn.execute(sql_str + " ORDER BY s.timestamp", params)
+        return [ dict(row) for row in rows ]
+
+    # Returns a list of namespace events, e.g. all drops of last week:
+    #   store.namespace_events('drop', since=datetime.now() - timedelta(days=7))
+    def namespace_events(self, event='drop', since=None, until=None, host=None):
+        sql_str = "SELECT host, timestamp, serial, nsid, event FROM ns_events WHERE event = ?"
+        params  = [ event ]
+        if not (since is None):
+            sql_str += " AND timestamp >= ?"
+            params.append(self._ts_str(since))
+        if not (until is None):
+            sql_str += " AND timestamp < ?"
+            params.append(self._ts_str(until))
+        if not (host is None):
+            sql_str += " AND host = ?"
+            params.append(host)
+        rows = self.conn.execute(sql_str + " ORDER BY timestamp", params)
+        return [ dict(row) for row in rows ]
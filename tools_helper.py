@@ -1,6 +1,12 @@
+import os
+import re
+import signal
+import socket
 import subprocess
 import json
+import time
 from paramiko import SSHClient, AutoAddPolicy
+from priv_agent import PrivAgentClient
 
 
 class LinuxToolsHelper(object):
@@ -65,9 +71,43 @@ class LinuxToolsHelper(object):
         def root(self):
             return self._pcie_path[0]
 
-    def __init__(self, ssh_login=None):
+    # per command family deadlines in seconds, keyed by the command name
+    # (after any 'sudo'); a drive that stops answering admin commands would
+    # otherwise block the exec forever.
+    CMD_TIMEOUTS = {
+        'nvme':    10.0,
+        'udevadm': 5.0,
+        'lspci':   5.0,
+        'find':    10.0,
+        'default': 30.0
+    }
+    # return codes in addition to 0 (ok), 1 (error) and 2 (exception)
+    RET_TIMEOUT      = 3
+    RET_UNRESPONSIVE = 4
+
+    # (optional) keyword arguments:
+    #   cmd_timeouts:<dict> override deadlines of CMD_TIMEOUTS by family
+    #   retries:<int>       number of retries of a command that timed out
+    #   backoff:<float>     seconds to wait before the first retry, doubled
+    #                       for every retry after that
+    #   breaker_limit:<int> consecutive timeouts before a device is marked
+    #                       unresponsive and no more commands are sent to it
+    #   use_agent:<bool>    run 'sudo' commands through one persistent
+    #                       privileged agent process per host (see priv_agent)
+    #   agent_opts:<dict>   options passed to PrivAgentClient
+    #
+    def __init__(self, ssh_login=None, **kwargs):
         self.client = None
         self.remote = not (ssh_login is None)
+        self.cmd_timeouts = dict(self.CMD_TIMEOUTS)
+        self.cmd_timeouts.update(kwargs.get('cmd_timeouts', {}))
+        self.retries       = kwargs.get('retries', 1)
+        self.backoff       = kwargs.get('backoff', 0.5)
+        self.breaker_limit = kwargs.get('breaker_limit', 1)
+        # circuit breaker state, keyed by controller dev node
+        self._dev_timeouts = {}
+        self._unresponsive = set()
+        self.agent = None
         if self.remote:
             login_ok = True
             for item_key in ssh_login.keys():
@@ -78,6 +118,8 @@ class LinuxToolsHelper(object):
                 self._r_connect(ssh_login)
             else:
                 self.log('ERROR', "incomplete SSH login credentials provided!")
+        if kwargs.get('use_agent', False):
+            self.start_agent(**kwargs.get('agent_opts', {}))
 
     # this can be overridden to log to an actual logger
     def log(self, err_lvl, msg_text):
@@ -102,18 +144,49 @@ class LinuxToolsHelper(object):
             self.client = None
 
     def _r_disconnect(self):
+        self.stop_agent()
         self.client.close()
         self.client = None
 
-    def _r_exec(self, cmd_list, cwd_opt):
+    # start the privileged agent; once running, commands prefixed with 'sudo'
+    # are sent to the agent instead of running sudo for each command.  If the
+    # agent can't be started commands keep using sudo.
+    def start_agent(self, **kwargs):
+        if self.remote and not self._r_is_connected():
+            self.log('ERROR', "ssh connection not established, can't start agent!")
+            return False
+        agent = PrivAgentClient(self.client, **kwargs)
+        if not agent.start():
+            self.log('ERROR', "failed to start privileged agent, using sudo per command")
+            return False
+        self.agent = agent
+        return True
+
+    def stop_agent(self):
+        if not (self.agent is None):
+            self.agent.close()
+            self.agent = None
+
+    def _a_exec(self, cmd_list, cwd_opt=None, timeout=None):
+        ret_code, stdout, stderr = self.agent.exec(cmd_list[1:], cwd_opt, timeout)
+        if ret_code == self.RET_TIMEOUT:
+            self.log('ERROR', "timeout ({}s) executing '{}'".format(timeout, " ".join(cmd_list)))
+        elif ret_code != 0:
+            self.log('ERROR', "failure executing '{}', returned:\n{}".format(" ".join(cmd_list), stderr))
+        return ret_code, stdout
+
+    def _r_exec(self, cmd_list, cwd_opt, timeout=None):
         if not self._r_is_connected():
             self.log('ERROR', "ssh connection not established!")
             return 1, ""
-        # Execute remote command
+        # Execute remote command, the remote 'timeout' tool kills the command
+        # on the host side; the channel timeout covers a hung connection.
+        if timeout is not None:
+            cmd_list = self._r_timeout_wrap(cmd_list, timeout)
         cmd_str  = " ".join(cmd_list)
         ret_code = 0
         try:
-            stdin, stdout, stderr = self.client.exec_command(cmd_str)
+            stdin, stdout, stderr = self.client.exec_command(cmd_str, timeout=timeout)
             stdin.close()
             ret_text = ''.join(stderr.readlines())
             if len(ret_text) > 0:
@@ -121,19 +194,62 @@ class LinuxToolsHelper(object):
                 ret_code = 1
             else:
                 ret_text = ''.join(stdout.readlines())
+            # 124 is returned by 'timeout' on expiry, 137 when it had to SIGKILL
+            if stdout.channel.recv_exit_status() in [ 124, 137 ]:
+                self.log('ERROR', "timeout ({}s) executing ssh {}".format(timeout, cmd_str))
+                ret_code = self.RET_TIMEOUT
+                ret_text = ""
+        except socket.timeout:
+            self.log('ERROR', "timeout ({}s) executing ssh {}".format(timeout, cmd_str))
+            ret_code = self.RET_TIMEOUT
+            ret_text = ""
         except Exception as exc:
             ret_text = "(EXCEPTION) failure executing ssh {}, returned:\n{}".format(cmd_str, exc)
             self.log('ERROR', ret_text)
             ret_code = 2
         return ret_code, ret_text
 
-    def _l_exec(self, cmd_list, cwd_opt=None):
+    @staticmethod
+    def _r_timeout_wrap(cmd_list, timeout):
+        # place 'timeout' after sudo so it runs with the same privileges as
+        # the command it has to kill.
+        timeout_cmd = [ 'timeout', '-k', '1', "{}".format(timeout) ]
+        if cmd_list[0] == 'sudo':
+            return cmd_list[:1] + timeout_cmd + cmd_list[1:]
+        return timeout_cmd + cmd_list
+
+    # kill the process group of a command that exceeded its deadline; sudo
+    # relays SIGTERM to its child, SIGKILL is the fallback for anything else
+    # left in the group.
+    def _l_kill(self, cmd_exec):
+        for sig_num in [ signal.SIGTERM, signal.SIGKILL ]:
+            try:
+                os.killpg(cmd_exec.pid, sig_num)
+            except (ProcessLookupError, PermissionError):
+                pass
+            try:
+                cmd_exec.communicate(timeout=1.0)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+        # a process stuck in the kernel can't be reaped, don't wait for it
+        self.log('ERROR', "unable to kill process group {}".format(cmd_exec.pid))
+
+    def _l_exec(self, cmd_list, cwd_opt=None, timeout=None):
         try:
+            # new session so the command and any children (sudo) can be
+            # killed as one process group on timeout
             cmd_exec = subprocess.Popen(cmd_list, cwd=cwd_opt,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
-                                        universal_newlines=True)
-            stdout, stderr = cmd_exec.communicate()
+                                        universal_newlines=True,
+                                        start_new_session=True)
+            try:
+                stdout, stderr = cmd_exec.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self._l_kill(cmd_exec)
+                self.log('ERROR', "timeout ({}s) executing '{}'".format(timeout, " ".join(cmd_list)))
+                return self.RET_TIMEOUT, ""
             ret_code = cmd_exec.poll()
             if ret_code != 0:
                 self.log('ERROR', "failure executing '{}', returned:\n{}".format(" ".join(cmd_list), stderr))
@@ -143,13 +259,147 @@ class LinuxToolsHelper(object):
             stdout = "{}".format(exc)
         return ret_code, stdout
 
-    def exec_str(self, cmd_str, cwd_opt=None):
-        return self.exec(cmd_str.split(' '), cwd_opt)
+    def exec_str(self, cmd_str, cwd_opt=None, dev_ref=None):
+        return self.exec(cmd_str.split(' '), cwd_opt, dev_ref)
+
+    # returns the deadline for a command based on its family (command name)
+    def cmd_timeout(self, cmd_list):
+        cmd_name = cmd_list[0]
+        if (cmd_name == 'sudo') and (len(cmd_list) > 1):
+            cmd_name = cmd_list[1]
+        cmd_name = os.path.basename(cmd_name)
+        return self.cmd_timeouts.get(cmd_name, self.cmd_timeouts.get('default', None))
+
+    # map a namespace block node (/dev/nvme0n1) to its controller node
+    # (/dev/nvme0), the circuit breaker is kept per controller.
+    @staticmethod
+    def dev_ref_ctrl(dev_ref):
+        match = re.match(r'^(.*?nvme\d+)', dev_ref)
+        if match is None:
+            return dev_ref
+        return match.group(1)
+
+    def is_unresponsive(self, dev_ref):
+        return self.dev_ref_ctrl(dev_ref) in self._unresponsive
+
+    def reset_unresponsive(self, dev_ref=None):
+        if dev_ref is None:
+            self._dev_timeouts = {}
+            self._unresponsive = set()
+        else:
+            ctrl_ref = self.dev_ref_ctrl(dev_ref)
+            self._dev_timeouts.pop(ctrl_ref, None)
+            self._unresponsive.discard(ctrl_ref)
+
+    def _dev_timeout(self, dev_ref):
+        ctrl_ref = self.dev_ref_ctrl(dev_ref)
+        timeouts = self._dev_timeouts.get(ctrl_ref, 0) + 1
+        self._dev_timeouts.update({ ctrl_ref: timeouts })
+        if timeouts >= self.breaker_limit:
+            self.log('ERROR', "device {} is unresponsive, skipping further commands".format(ctrl_ref))
+            self._unresponsive.add(ctrl_ref)
+
+    # (optional) dev_ref is the device node the command talks to; commands
+    # to a device marked unresponsive are not executed.
+    def exec(self, cmd_list, cwd_opt=None, dev_ref=None):
+        if (dev_ref is not None) and self.is_unresponsive(dev_ref):
+            return self.RET_UNRESPONSIVE, ""
+        timeout = self.cmd_timeout(cmd_list)
+        attempt = 0
+        while True:
+            if (cmd_list[0] == 'sudo') and (self.agent is not None) and self.agent.is_alive():
+                ret_code, ret_text = self._a_exec(cmd_list, cwd_opt, timeout)
+            elif self.remote:
+                ret_code, ret_text = self._r_exec(cmd_list, cwd_opt, timeout)
+            else:
+                ret_code, ret_text = self._l_exec(cmd_list, cwd_opt, timeout)
+            if (ret_code != self.RET_TIMEOUT) or (attempt >= self.retries):
+                break
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+        if dev_ref is not None:
+            if ret_code == self.RET_TIMEOUT:
+                self._dev_timeout(dev_ref)
+            else:
+                self._dev_timeouts.pop(self.dev_ref_ctrl(dev_ref), None)
+        return ret_code, ret_text
 
-    def exec(self, cmd_list, cwd_opt=None):
-        if self.remote:
-            return self._r_exec(cmd_list, cwd_opt)
-        return self._l_exec(cmd_list, cwd_opt)
+    def _l_exec_to_file(self, cmd_list, out_file, timeout=None):
+        try:
+            # the command writes straight into the file, its output never
+            # passes through this process
+            cmd_exec = subprocess.Popen(cmd_list, stdout=out_file,
+                                        stderr=subprocess.PIPE,
+                                        start_new_session=True)
+            try:
+                _, stderr = cmd_exec.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self._l_kill(cmd_exec)
+                self.log('ERROR', "timeout ({}s) executing '{}'".format(timeout, " ".join(cmd_list)))
+                return self.RET_TIMEOUT
+            ret_code = cmd_exec.poll()
+            if ret_code != 0:
+                self.log('ERROR', "failure executing '{}', returned:\n{}".format(" ".join(cmd_list),
+                                                                              stderr.decode('utf-8', 'replace')))
+        except Exception as exc:
+            self.log('ERROR', "(EXCEPTION) failure executing '{}', returned:\n{}".format(" ".join(cmd_list), exc))
+            ret_code = 2
+        return ret_code
+
+    def _r_exec_to_file(self, cmd_list, out_file, timeout=None, chunk_size=1 << 20):
+        if not self._r_is_connected():
+            self.log('ERROR', "ssh connection not established!")
+            return 1
+        if timeout is not None:
+            cmd_list = self._r_timeout_wrap(cmd_list, timeout)
+        cmd_str = " ".join(cmd_list)
+        try:
+            channel = self.client.get_transport().open_session()
+            channel.settimeout(timeout)
+            channel.exec_command(cmd_str)
+            # binary output is written to the file in chunks as it arrives
+            while True:
+                chunk = channel.recv(chunk_size)
+                if len(chunk) == 0:
+                    break
+                out_file.write(chunk)
+            ret_code = channel.recv_exit_status()
+            channel.close()
+            if ret_code in [ 124, 137 ]:
+                self.log('ERROR', "timeout ({}s) executing ssh {}".format(timeout, cmd_str))
+                return self.RET_TIMEOUT
+            if ret_code != 0:
+                self.log('ERROR', "failure executing ssh {}, returned: {}".format(cmd_str, ret_code))
+        except socket.timeout:
+            self.log('ERROR', "timeout ({}s) executing ssh {}".format(timeout, cmd_str))
+            ret_code = self.RET_TIMEOUT
+        except Exception as exc:
+            self.log('ERROR', "(EXCEPTION) failure executing ssh {}, returned:\n{}".format(cmd_str, exc))
+            ret_code = 2
+        return ret_code
+
+    # execute a command and stream its (binary) stdout into file_path; used
+    # for large log pages.  Commands run with sudo directly, not through the
+    # privileged agent.  Returns ret_code and the number of bytes written.
+    #   timeout: overrides the command family deadline, large logs can take
+    #            much longer than an identify.
+    def exec_to_file(self, cmd_list, file_path, dev_ref=None, timeout=None):
+        if (dev_ref is not None) and self.is_unresponsive(dev_ref):
+            return self.RET_UNRESPONSIVE, 0
+        if timeout is None:
+            timeout = self.cmd_timeout(cmd_list)
+        with open(file_path, 'wb') as out_file:
+            if self.remote:
+                ret_code = self._r_exec_to_file(cmd_list, out_file, timeout)
+            else:
+                ret_code = self._l_exec_to_file(cmd_list, out_file, timeout)
+            out_size = out_file.tell()
+        if dev_ref is not None:
+            if ret_code == self.RET_TIMEOUT:
+                self._dev_timeout(dev_ref)
+            else:
+                self._dev_timeouts.pop(self.dev_ref_ctrl(dev_ref), None)
+        return ret_code, out_size
 
     # find_dev_nodes - this will locate device nodes in the /dev hierarchy by device type
     #   type:  c - char devices (default)
@@ -229,6 +479,31 @@ class LinuxToolsHelper(object):
             return path_hlpr
         return None
 
+    # Example:
+    #   $ cat /sys/bus/pci/devices/0000:04:00.0/current_link_width ...
+    #   4
+    #   8.0 GT/s PCIe
+    #   4
+    #   8.0 GT/s PCIe
+    #
+    # returns a dictionary of the current and max link width / speed, or None
+    # if the sysfs attributes can't be read.
+    def pcie_get_link_status(self, bdf):
+        link_attrs = [ 'current_link_width', 'current_link_speed', 'max_link_width', 'max_link_speed' ]
+        cat_cmd    = [ 'cat' ] + [ "/sys/bus/pci/devices/{}/{}".format(bdf, attr) for attr in link_attrs ]
+        ret_code, cat_out = self.exec(cat_cmd)
+        if ret_code == 0:
+            values = cat_out.strip().split('\n')
+            if len(values) == len(link_attrs):
+                ret_dict = {}
+                for attr, value in zip(link_attrs, values):
+                    value = value.strip()
+                    if attr.endswith('_width'):
+                        value = int(value)
+                    ret_dict.update({ attr: value })
+                return ret_dict
+        return None
+
     def lspci_get_bdf_list(self, filter="Non-"):
         lspci_cmd = [ 'lspci', '-D' ]
         ret_code, lspci_out = self.exec(lspci_cmd)
@@ -259,14 +534,14 @@ class LinuxToolsHelper(object):
 
     def nvme_get_ns_identify(self, block_node):
         nvme_cmd = [ 'sudo', 'nvme', 'id-ns', block_node, '-o', 'json' ]
-        ret_code, ns_data = self.exec(nvme_cmd)
+        ret_code, ns_data = self.exec(nvme_cmd, dev_ref=block_node)
         if ret_code == 0:
             return json.loads(ns_data)
         return {}
 
     def nvme_get_ns_identify_by_id(self, dev_node, ns_id):
         nvme_cmd = [ 'sudo', 'nvme', 'id-ns', dev_node, '-o', 'json', '-n', str(ns_id) ]
-        ret_code, ns_data = self.exec(nvme_cmd)
+        ret_code, ns_data = self.exec(nvme_cmd, dev_ref=dev_node)
         if ret_code == 0:
             return json.loads(ns_data)
         return {}
@@ -275,7 +550,7 @@ class LinuxToolsHelper(object):
         # get list of namespace ids, -a option doesn't seem to work on some drives
         # and there is no json out.
         nvme_cmd = [ 'sudo', 'nvme', 'list-ns', dev_node ]
-        ret_code, nvme_out = self.exec(nvme_cmd)
+        ret_code, nvme_out = self.exec(nvme_cmd, dev_ref=dev_node)
         ret_list = []
         if ret_code == 0:
             for line_item in nvme_out.split('\n'):
@@ -292,14 +567,71 @@ class LinuxToolsHelper(object):
 
     def nvme_get_ctrl_identify(self, dev_node):
         nvme_cmd = [ 'sudo', 'nvme', 'id-ctrl', dev_node, '-o', 'json' ]
-        ret_code, ctrl_data = self.exec(nvme_cmd)
+        ret_code, ctrl_data = self.exec(nvme_cmd, dev_ref=dev_node)
         if ret_code == 0:
             return json.loads(ctrl_data)
         return {}
 
+    def nvme_get_smart_log(self, dev_node):
+        nvme_cmd = [ 'sudo', 'nvme', 'smart-log', dev_node, '-o', 'json' ]
+        ret_code, smart_data = self.exec(nvme_cmd, dev_ref=dev_node)
+        if ret_code == 0:
+            return json.loads(smart_data)
+        return {}
+
+    # Example:
+    #   $ sudo nvme get-feature /dev/nvme0 -f 7 -s 0
+    #   get-feature:0x07 (Number of Queues), Current value:0x003f003f
+    #
+    # returns the feature value (completion dword 0) as int, or None.
+    #   sel: 0 current, 1 default, 2 saved value
+    def nvme_get_feature(self, dev_node, feature_id, sel=0):
+        nvme_cmd = [ 'sudo', 'nvme', 'get-feature', dev_node, '-f', str(feature_id), '-s', str(sel) ]
+        ret_code, nvme_out = self.exec(nvme_cmd, dev_ref=dev_node)
+        if ret_code == 0:
+            match = re.search(r'value:\s*(0x[0-9a-fA-F]+)', nvme_out)
+            if not (match is None):
+                return int(match.group(1), 16)
+        return None
+
+    # returns the list of error log entries, newest first; entries limits the
+    # number of entries read from the drive (default is all, elpe + 1).
+    def nvme_get_error_log(self, dev_node, entries=None):
+        nvme_cmd = [ 'sudo', 'nvme', 'error-log', dev_node, '-o', 'json' ]
+        if not (entries is None):
+            nvme_cmd += [ '-e', str(entries) ]
+        ret_code, log_data = self.exec(nvme_cmd, dev_ref=dev_node)
+        if ret_code == 0:
+            return json.loads(log_data).get('errors', [])
+        return None
+
+    # capture the telemetry log (host-initiated, or controller-initiated if
+    # host_init is False) as binary into file_path; returns ret_code and the
+    # number of bytes captured.
+    def nvme_get_telemetry_log(self, dev_node, file_path, host_init=True, data_area=3, timeout=300.0):
+        nvme_cmd = [ 'sudo', 'nvme', 'telemetry-log', dev_node, '--output-file=/dev/stdout',
+                     '--data-area={}'.format(data_area) ]
+        if host_init:
+            nvme_cmd.append('--host-generate=1')
+        else:
+            nvme_cmd.append('--controller-init')
+        return self.exec_to_file(nvme_cmd, file_path, dev_ref=dev_node, timeout=timeout)
+
+    # capture any log page (e.g. vendor specific) as binary into file_path
+    #   lsp: log specific field, e.g. the persistent event log context action
+    #   lpo: byte offset into the log page to start reading at (dword aligned)
+    def nvme_get_log_raw(self, dev_node, file_path, log_id, log_len, timeout=300.0, lsp=None, lpo=None):
+        nvme_cmd = [ 'sudo', 'nvme', 'get-log', dev_node, '--log-id={}'.format(log_id),
+                     '--log-len={}'.format(log_len), '--raw-binary' ]
+        if not (lsp is None):
+            nvme_cmd.append('--lsp={}'.format(lsp))
+        if not (lpo is None):
+            nvme_cmd.append('--lpo={}'.format(lpo))
+        return self.exec_to_file(nvme_cmd, file_path, dev_ref=dev_node, timeout=timeout)
+
     def nvme_get_ctrl_identify_by_id(self, dev_node, ctrl_id):
         nvme_cmd = [ 'sudo', 'nvme', 'id-ctrl', dev_node, '-o', 'json', '-c', str(ctrl_id) ]
-        ret_code, ctrl_data = self.exec(nvme_cmd)
+        ret_code, ctrl_data = self.exec(nvme_cmd, dev_ref=dev_node)
         if ret_code == 0:
             return json.loads(ctrl_data)
         else:
@@ -309,7 +641,7 @@ class LinuxToolsHelper(object):
     def nvme_get_controller_list(self, dev_node):
         # get list of controller ids, this does NOT work on all NVMe drives.
         nvme_cmd = [ 'sudo', 'nvme', 'list-ctrl', dev_node ]
-        ret_code, nvme_out = self.exec(nvme_cmd)
+        ret_code, nvme_out = self.exec(nvme_cmd, dev_ref=dev_node)
         ret_list = []
         if ret_code == 0:
             for line_item in nvme_out.split('\n'):
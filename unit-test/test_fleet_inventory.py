@@ -0,0 +1,54 @@
+import unittest
+from fleet_inventory import FleetInventory
+from test_scan_diff import make_ctrl
+
+
+class FleetInventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = FleetInventory()
+        for host_index in range(10):
+            ctrl_list = []
+            for dev_index in range(4):
+                fw   = 'E2MU200' if dev_index < 3 else 'E2MU110'
+                ctrl = make_ctrl('SN{:02d}{:02d}'.format(host_index, dev_index), 1,
+                                 '0000:0{}:00.0'.format(dev_index + 2), '/dev/nvme{}'.format(dev_index),
+                                 fw, [ (1, 1000), (2, 2000) ])
+                ctrl['id_ctrl'].update({ 'mn': 'MODEL_A  ' if dev_index % 2 else 'MODEL_B  ',
+                                         'psds': [ { 'max_power': 2500 }, { 'max_power': 1200 } ] })
+                ctrl_list.append(ctrl)
+            self.fleet.add_scan({ 'ctrl_list': ctrl_list }, 'host{}'.format(host_index))
+
+    def test_01_columns(self):
+        self.assertEqual(self.fleet.ctrl_count(), 40)
+        self.assertEqual(self.fleet.ns_count(), 80)
+        self.assertEqual(self.fleet.ns_column('nsze').sum(), 40 * 3000)
+        self.assertEqual(len(self.fleet.str_dicts['model']), 2)
+        self.assertEqual(len(self.fleet.str_dicts['serial']), 40)
+
+    def test_02_interned_payloads(self):
+        # one payload per model / firmware combination (3) plus the two
+        # power states and the shared id_ns
+        id_ctrl_a = self.fleet.id_ctrl(0)
+        id_ctrl_b = self.fleet.id_ctrl(4)
+        self.assertEqual(id_ctrl_a['sn'].strip(), 'SN0000')
+        self.assertEqual(id_ctrl_b['sn'].strip(), 'SN0100')
+        self.assertEqual(id_ctrl_a['fr'], 'E2MU200')
+        self.assertIs(id_ctrl_a['psds'], id_ctrl_b['psds'])
+        self.assertEqual(len(self.fleet._payloads), 3 + 2 + 1)
+
+    def test_03_group_by(self):
+        self.assertEqual(self.fleet.count_by('fw'), { 'E2MU200': 30, 'E2MU110': 10 })
+        mask = self.fleet.ctrl_mask(fw='E2MU110')
+        self.assertEqual(self.fleet.count_by('model', mask), { 'MODEL_A': 10 })
+        self.assertEqual(self.fleet.sum_by('capacity', 'host', mask)['host3'], 960197124096)
+        self.assertEqual(self.fleet.ns_count_by('model'), { 'MODEL_A': 40, 'MODEL_B': 40 })
+        self.assertEqual(self.fleet.ns_sum_by('nsze', 'fw', mask), { 'E2MU110': 10 * 3000 })
+        self.assertEqual(self.fleet.count_by('cntlid'), { 1: 40 })
+        self.assertFalse(self.fleet.ctrl_mask(model='NO_SUCH_MODEL').any())
+        mask = self.fleet.ctrl_mask(host='host1') & (self.fleet.ctrl_column('capacity') > 0)
+        self.assertEqual(int(mask.sum()), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from log_capture import TelemetryLog, LogCapture
+from tools_helper import LinuxToolsHelper
+
+
+def make_telemetry(file_path, area_last, data_blocks):
+    header = bytearray(TelemetryLog.BLOCK_SIZE)
+    header[0] = 0x07
+    header[5:8] = b'\x00\xa0\x75'
+    struct.pack_into('<HHH', header, 8, *area_last[:3])
+    struct.pack_into('<I', header, 16, area_last[3])
+    header[382] = 1
+    header[383] = 5
+    with open(file_path, 'wb') as out_file:
+        out_file.write(header)
+        for block in range(1, data_blocks + 1):
+            out_file.write(bytes([ block % 256 ]) * TelemetryLog.BLOCK_SIZE)
+
+
+# helper replacement that writes a synthetic telemetry log, and tracks the
+# number of captures running at the same time
+class FakeCaptureHelper(LinuxToolsHelper):
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight     = 0
+        self.max_in_flight = 0
+        self._count_lock   = threading.Lock()
+
+    def nvme_get_telemetry_log(self, dev_node, file_path, host_init=True, data_area=3, timeout=300.0):
+        with self._count_lock:
+            self.in_flight    += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.1)
+        make_telemetry(file_path, [ 2, 3, 3, 3 ], 3)
+        with self._count_lock:
+            self.in_flight -= 1
+        return 0, os.path.getsize(file_path)
+
+
+class LogCaptureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_01_telemetry_header(self):
+        file_path = os.path.join(self.tmp_dir.name, 'telemetry.bin')
+        # area 3 is empty, area 4 was not captured (beyond the file)
+        make_telemetry(file_path, [ 2, 4, 4, 8 ], 4)
+        with TelemetryLog(file_path) as telemetry:
+            self.assertEqual(telemetry.log_id(), 0x07)
+            self.assertEqual(telemetry.area_last_blocks(), [ 2, 4, 4, 8 ])
+            area_1 = telemetry.data_area(1)
+            self.assertIsInstance(area_1, memoryview)
+            self.assertEqual(len(area_1), 2 * TelemetryLog.BLOCK_SIZE)
+            self.assertEqual(area_1[0], 1)
+            self.assertEqual(area_1[TelemetryLog.BLOCK_SIZE], 2)
+            self.assertEqual(telemetry.data_area(2)[0], 3)
+            area_1.release()
+            summary = telemetry.summary()
+            self.assertEqual(summary['ieee_oui'], '00a075')
+            self.assertEqual(summary['area_sizes'], [ 1024, 1024, 0, 0 ])
+            self.assertEqual(summary['ctrl_gen'], 5)
+            with self.assertRaises(IndexError):
+                telemetry.data_area(5)
+
+    def test_02_truncated_header(self):
+        file_path = os.path.join(self.tmp_dir.name, 'short.bin')
+        with open(file_path, 'wb') as out_file:
+            out_file.write(b'\x07' * 100)
+        with self.assertRaises(ValueError):
+            TelemetryLog(file_path)
+
+    def test_03_exec_to_file(self):
+        local_tools = LinuxToolsHelper()
+        file_path   = os.path.join(self.tmp_dir.name, 'stream.bin')
+        ret_code, size = local_tools.exec_to_file([ 'head', '-c', '3000000', '/dev/zero' ], file_path)
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(size, 3000000)
+        self.assertEqual(os.path.getsize(file_path), 3000000)
+        ret_code, size = local_tools.exec_to_file([ 'sleep', '5' ], file_path, dev_ref='/dev/nvme99', timeout=0.5)
+        self.assertEqual(ret_code, LinuxToolsHelper.RET_TIMEOUT)
+        self.assertTrue(local_tools.is_unresponsive('/dev/nvme99'))
+
+    def test_04_bounded_concurrent_capture(self):
+        tools   = FakeCaptureHelper()
+        capture = LogCapture(tools, os.path.join(self.tmp_dir.name, 'logs'), max_in_flight=3)
+        results = capture.capture_telemetry([ '/dev/nvme{}'.format(index) for index in range(9) ])
+        self.assertEqual(len(results), 9)
+        self.assertEqual(tools.max_in_flight, 3)
+        self.assertEqual(results[4]['dev_node'], '/dev/nvme4')
+        self.assertEqual(results[4]['header']['area_sizes'], [ 1024, 512, 0, 0 ])
+
+
+if __name__ == '__main__':
+    unittest.main()
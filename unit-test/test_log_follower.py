@@ -0,0 +1,210 @@
+import os
+import struct
+import tempfile
+import unittest
+from log_follower import ErrorLogFollower, EventLogFollower
+
+
+# helper replacement with a scripted error log per dev node
+class FakeLogHelper(object):
+
+    def __init__(self, elpe=3, serials=None):
+        self.elpe       = elpe
+        self.errors     = { '/dev/nvme0': 0, '/dev/nvme1': 0 }
+        # dev_node: serial, default is one serial per dev node
+        self.serials    = serials or {}
+        self.log_reads  = []
+        self.messages   = []
+
+    def log(self, err_lvl, msg_text):
+        self.messages.append((err_lvl, msg_text))
+
+    def find_nvme_dev_nodes(self):
+        return sorted(self.errors.keys())
+
+    def nvme_get_ctrl_identify(self, dev_node):
+        serial = self.serials.get(dev_node, 'SN{}'.format(dev_node[-1]))
+        return { 'sn': '{}   '.format(serial), 'cntlid': int(dev_node[-1]) + 1, 'elpe': self.elpe }
+
+    def nvme_get_smart_log(self, dev_node):
+        return { 'num_err_log_entries': self.errors[dev_node] }
+
+    def nvme_get_error_log(self, dev_node, entries=None):
+        self.log_reads.append((dev_node, entries))
+        # newest first, the log only keeps elpe + 1 entries
+        err_count = self.errors[dev_node]
+        return [ { 'error_count': count, 'sqid': 0, 'cmdid': count }
+                 for count in range(err_count, max(err_count - entries, 0), -1) ]
+
+
+# helper replacement with a scripted persistent event log on /dev/nvme0
+class FakeEventHelper(object):
+
+    def __init__(self, lpa=0x10):
+        self.lpa        = lpa
+        self.events     = []
+        self.total      = 0
+        self.generation = 1
+        self.log_reads  = []
+        self.messages   = []
+
+    def log(self, err_lvl, msg_text):
+        self.messages.append((err_lvl, msg_text))
+
+    def find_nvme_dev_nodes(self):
+        return [ '/dev/nvme0' ]
+
+    def nvme_get_ctrl_identify(self, dev_node):
+        return { 'sn': 'SN0   ', 'cntlid': 1, 'lpa': self.lpa }
+
+    # events have 5 data bytes, so they don't end on a dword boundary
+    def add_event(self, timestamp):
+        self.events.append(struct.pack('<BBBxHQ6xHH', 1, 1, 21, 1, timestamp, 0, 5) + bytes(5))
+        self.total += 1
+
+    def log_page(self):
+        body   = b''.join(self.events)
+        header = bytearray(512)
+        header[0] = 0x0D
+        struct.pack_into('<IQ', header, 4, self.total, 512 + len(body))
+        struct.pack_into('<H', header, 372, self.generation)
+        return bytes(header) + body
+
+    def nvme_get_log_raw(self, dev_node, file_path, log_id, log_len, timeout=300.0, lsp=None, lpo=None):
+        self.log_reads.append((lsp, lpo, log_len))
+        log_data = self.log_page()[lpo:lpo + log_len]
+        with open(file_path, 'wb') as out_file:
+            out_file.write(log_data)
+        return 0, len(log_data)
+
+
+class ErrorLogFollowerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir    = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp_dir.name, 'state.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_01_only_new_entries(self):
+        tools = FakeLogHelper()
+        tools.errors['/dev/nvme0'] = 5
+        follower = ErrorLogFollower(tools, self.state_file)
+        # first poll starts at the current position
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(tools.log_reads, [])
+        tools.errors['/dev/nvme0'] = 7
+        tools.errors['/dev/nvme1'] = 1
+        new_entries = follower.poll()
+        self.assertEqual([ (dev_node, serial, entry['error_count']) for dev_node, serial, entry in new_entries ],
+                         [ ('/dev/nvme0', 'SN0', 6), ('/dev/nvme0', 'SN0', 7), ('/dev/nvme1', 'SN1', 1) ])
+        # only as many entries as are new are read
+        self.assertEqual(tools.log_reads, [ ('/dev/nvme0', 2), ('/dev/nvme1', 1) ])
+        # no change, no error log reads
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(len(tools.log_reads), 2)
+
+    def test_02_persistent_position(self):
+        tools = FakeLogHelper()
+        tools.errors['/dev/nvme0'] = 2
+        follower = ErrorLogFollower(tools, self.state_file, from_start=True)
+        self.assertEqual(len(follower.poll()), 2)
+        tools.errors['/dev/nvme0'] = 3
+        # a new follower continues from the saved position
+        follower = ErrorLogFollower(tools, self.state_file, from_start=True)
+        new_entries = list(follower.follow(interval=0, polls=2))
+        self.assertEqual([ entry['error_count'] for _, _, entry in new_entries ], [ 3 ])
+
+    def test_03_missed_entries(self):
+        tools = FakeLogHelper(elpe=3)
+        follower = ErrorLogFollower(tools, self.state_file, dev_nodes=[ '/dev/nvme0' ])
+        follower.poll()
+        tools.errors['/dev/nvme0'] = 10
+        new_entries = follower.poll()
+        self.assertEqual([ entry['error_count'] for _, _, entry in new_entries ], [ 7, 8, 9, 10 ])
+        self.assertEqual(tools.messages[0][0], 'WARN')
+        # count going backwards resets the position
+        tools.errors['/dev/nvme0'] = 1
+        self.assertEqual(follower.poll(), [])
+        tools.errors['/dev/nvme0'] = 2
+        self.assertEqual([ entry['error_count'] for _, _, entry in follower.poll() ], [ 2 ])
+
+    def test_04_dual_port_drive(self):
+        # both ports of a dual port drive report the same serial
+        serials = { '/dev/nvme0': 'SN0', '/dev/nvme1': 'SN0' }
+        tools = FakeLogHelper(serials=serials)
+        tools.errors['/dev/nvme0'] = 4
+        tools.errors['/dev/nvme1'] = 1
+        follower = ErrorLogFollower(tools, self.state_file)
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(sorted(follower.state.keys()), [ 'SN0:1', 'SN0:2' ])
+        tools.errors['/dev/nvme0'] = 5
+        tools.errors['/dev/nvme1'] = 2
+        new_entries = follower.poll()
+        self.assertEqual([ (dev_node, entry['error_count']) for dev_node, _, entry in new_entries ],
+                         [ ('/dev/nvme0', 5), ('/dev/nvme1', 2) ])
+        self.assertEqual(follower.poll(), [])
+        # positions survive a restart per controller
+        follower = ErrorLogFollower(tools, self.state_file)
+        tools.errors['/dev/nvme1'] = 3
+        self.assertEqual([ (dev_node, entry['error_count']) for dev_node, _, entry in follower.poll() ],
+                         [ ('/dev/nvme1', 3) ])
+
+    def test_05_event_log_new_events(self):
+        tools = FakeEventHelper()
+        tools.add_event(100)
+        tools.add_event(200)
+        follower = EventLogFollower(tools, self.state_file)
+        # first poll only reads the header
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(tools.log_reads, [ (1, 0, 512), (2, 0, 512) ])
+        tools.log_reads = []
+        tools.add_event(300)
+        tools.add_event(400)
+        new_entries = follower.poll()
+        self.assertEqual([ (entry['event_number'], entry['timestamp']) for _, _, entry in new_entries ],
+                         [ (3, 300), (4, 400) ])
+        self.assertEqual(new_entries[0][2]['cntlid'], 1)
+        # only the new events are read, under the established context
+        self.assertEqual(tools.log_reads, [ (1, 0, 512), (0, 568, 60), (2, 0, 512) ])
+        tools.log_reads = []
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(len(tools.log_reads), 2)
+        # a new follower continues from the saved position
+        tools.add_event(500)
+        follower = EventLogFollower(tools, self.state_file)
+        self.assertEqual([ entry['timestamp'] for _, _, entry in follower.poll() ], [ 500 ])
+
+    def test_06_event_log_dropped_events(self):
+        tools = FakeEventHelper()
+        tools.add_event(100)
+        tools.add_event(200)
+        follower = EventLogFollower(tools, self.state_file, from_start=True)
+        self.assertEqual([ entry['timestamp'] for _, _, entry in follower.poll() ], [ 100, 200 ])
+        # the log is full, the oldest event makes room for new ones
+        tools.events.pop(0)
+        tools.add_event(300)
+        tools.add_event(400)
+        self.assertEqual([ (entry['event_number'], entry['timestamp']) for _, _, entry in follower.poll() ],
+                         [ (3, 300), (4, 400) ])
+        # a cleared log starts over at the current position
+        tools.generation += 1
+        tools.add_event(500)
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(tools.messages[-1][0], 'WARN')
+        tools.add_event(600)
+        self.assertEqual([ entry['timestamp'] for _, _, entry in follower.poll() ], [ 600 ])
+        # the context is released after every poll
+        self.assertEqual(tools.log_reads[-1][0], 2)
+
+    def test_07_event_log_unsupported(self):
+        tools = FakeEventHelper(lpa=0)
+        tools.add_event(100)
+        follower = EventLogFollower(tools, self.state_file, from_start=True)
+        self.assertEqual(follower.poll(), [])
+        self.assertEqual(tools.log_reads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
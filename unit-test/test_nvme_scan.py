@@ -1,6 +1,52 @@
 import unittest
 import json
+import threading
 from nvme_scan import get_args, NvmeDeviceCollector
+from tools_helper import LinuxToolsHelper
+
+
+# helper replacement answering get-feature with the feature id as value
+class FakeFeatureHelper(object):
+
+    def __init__(self):
+        self.requests = []
+        self._lock    = threading.Lock()
+
+    def nvme_get_feature(self, dev_node, feature_id, sel=0):
+        with self._lock:
+            self.requests.append((dev_node, feature_id))
+        if feature_id == 0x0B:
+            # failed command
+            return None
+        return feature_id
+
+
+# helper with scripted command output for one controller, id-ctrl times out
+# while hung is set
+class FakeExecHelper(LinuxToolsHelper):
+
+    def __init__(self):
+        super().__init__(retries=0)
+        self.hung = False
+
+    def find_nvme_dev_nodes(self):
+        return [ '/dev/nvme0' ]
+
+    def find_nvme_namespace_dev_nodes(self, no_p_devs=True):
+        return [ '/dev/nvme0n1' ]
+
+    def _l_exec(self, cmd_list, cwd_opt=None, timeout=None):
+        if cmd_list[0] == 'udevadm':
+            return 0, "/devices/pci0000:00/0000:00:01.1/0000:02:00.0/nvme/nvme0\n"
+        if 'list-ns' in cmd_list:
+            return 0, "[   0]:0x1\n"
+        if 'id-ns' in cmd_list:
+            return 0, json.dumps({ 'nsze': 1000 })
+        if 'id-ctrl' in cmd_list:
+            if self.hung:
+                return self.RET_TIMEOUT, ""
+            return 0, json.dumps({ 'sn': 'SN0001', 'cntlid': 1 })
+        return 1, ""
 
 
 class NvmeScanTestCase(unittest.TestCase):
@@ -123,5 +169,67 @@ class NvmeScanTestCase(unittest.TestCase):
         dev_data  = nvme_hlpr.new_scan()
         print("Device Collector Data:\n{}".format(json.dumps(dev_data)))
 
+    def test_11_diff_command(self):
+        test_args = [
+            "diff", "sample_data_file.json", "sample_data_file.json",
+            "--ctrl-fields", "fw,bdf"
+        ]
+        args = get_args(test_args)
+        self.assertEqual(args.command, 'diff')
+        self.assertEqual(args.diff_files, test_args[1:3])
+        self.assertEqual(args.diff_ctrl_fields, ['fw', 'bdf'])
+        self.assertIsNone(args.diff_ns_fields)
+        self.assertFalse(args.diff_scan)
+
+    def test_12_diff_command_missing_file(self):
+        test_args = [
+            "diff", "sample_data_file.json", "nonexisting_in_file.json"
+        ]
+        args = get_args(test_args)
+        self.assertEqual(args.command, 'scan')
+        self.assertIsNone(args.diff_files)
+
+    def test_13_query_command(self):
+        test_args = [
+            "query", 'model~"7450" and fw<"E2MU200"', "sample_data_file.json"
+        ]
+        args = get_args(test_args)
+        self.assertEqual(args.command, 'query')
+        self.assertEqual(args.query_file, test_args[2])
+        self.assertEqual(args.query.run({}), [])
+        # syntax errors are rejected up front
+        args = get_args([ "query", 'model~' ])
+        self.assertEqual(args.command, 'scan')
+        self.assertIsNone(args.query)
+
+    def test_14_feature_snapshot(self):
+        tools_hlpr = FakeFeatureHelper()
+        full_scan  = { 'ctrl_list': [
+            { 'dev_node': '/dev/nvme0', 'state': 'ok', 'id_ctrl': { 'vwc': 1, 'apsta': 0 } },
+            { 'dev_node': '/dev/nvme1', 'state': 'ok', 'id_ctrl': { 'vwc': 0, 'apsta': 1 } },
+            { 'dev_node': '/dev/nvme2', 'state': 'unresponsive', 'id_ctrl': {} }
+        ] }
+        nvme_hlpr = NvmeDeviceCollector(tools_hlpr=tools_hlpr, full_scan=full_scan)
+        nvme_hlpr.feature_snapshot([ 0x06, 0x07, 0x0B, 0x0C ])
+        ctrl_list = nvme_hlpr.full_scan['ctrl_list']
+        self.assertEqual(ctrl_list[0]['features'], { '0x06': 0x06, '0x07': 0x07 })
+        self.assertEqual(ctrl_list[1]['features'], { '0x07': 0x07, '0x0c': 0x0C })
+        self.assertEqual(ctrl_list[2]['features'], {})
+        # unsupported features and unresponsive controllers are not queried
+        self.assertEqual(sorted(tools_hlpr.requests), [ ('/dev/nvme0', 0x06), ('/dev/nvme0', 0x07), ('/dev/nvme0', 0x0B),
+                                                        ('/dev/nvme1', 0x07), ('/dev/nvme1', 0x0B), ('/dev/nvme1', 0x0C) ])
+
+    def test_15_unresponsive_per_scan(self):
+        tools_hlpr = FakeExecHelper()
+        nvme_hlpr  = NvmeDeviceCollector(tools_hlpr=tools_hlpr)
+        tools_hlpr.hung = True
+        full_scan = nvme_hlpr.new_scan()
+        self.assertEqual(full_scan['ctrl_list'][0]['state'], 'unresponsive')
+        # the controller recovered, the next scan queries it again
+        tools_hlpr.hung = False
+        full_scan = nvme_hlpr.new_scan()
+        self.assertEqual(full_scan['ctrl_list'][0]['state'], 'ok')
+        self.assertEqual(full_scan['ctrl_list'][0]['cntlid'], 1)
+
 if __name__ == '__main__':
     unittest.main()
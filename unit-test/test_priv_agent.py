@@ -0,0 +1,63 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from priv_agent import PrivAgentClient, RET_TIMEOUT
+from tools_helper import LinuxToolsHelper
+
+
+class PrivAgentTestCase(unittest.TestCase):
+
+    # the agent is started without sudo, the protocol is the same
+    def setUp(self):
+        self.agent = PrivAgentClient(use_sudo=False)
+        self.assertTrue(self.agent.start())
+
+    def tearDown(self):
+        self.agent.close()
+        self.assertFalse(self.agent.is_alive())
+
+    def test_01_exec(self):
+        ret_code, stdout, stderr = self.agent.exec([ 'echo', 'hello' ])
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(stdout, "hello\n")
+        ret_code, stdout, stderr = self.agent.exec([ 'ls', '/no/such/path' ])
+        self.assertNotEqual(ret_code, 0)
+        self.assertTrue(len(stderr) > 0)
+        ret_code, stdout, stderr = self.agent.exec([ 'pwd' ], cwd_opt='/')
+        self.assertEqual(stdout, "/\n")
+
+    def test_02_concurrent_requests(self):
+        # slow and fast requests are multiplexed, each gets its own result
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda index: self.agent.exec([ 'sh', '-c', 'sleep 0.5; echo {}'.format(index) ]),
+                                        range(8)))
+        self.assertTrue(time.monotonic() - start_time < 3.0)
+        for index, (ret_code, stdout, stderr) in enumerate(results):
+            self.assertEqual(ret_code, 0)
+            self.assertEqual(stdout.strip(), "{}".format(index))
+
+    def test_03_timeout(self):
+        ret_code, stdout, stderr = self.agent.exec([ 'sleep', '5' ], timeout=0.5)
+        self.assertEqual(ret_code, RET_TIMEOUT)
+        # the agent keeps working after a command timed out
+        ret_code, stdout, stderr = self.agent.exec([ 'echo', 'ok' ])
+        self.assertEqual(stdout, "ok\n")
+
+    def test_04_tools_helper_agent(self):
+        tools = LinuxToolsHelper(use_agent=True, agent_opts={ 'use_sudo': False }, retries=0)
+        self.assertIsNotNone(tools.agent)
+        # 'sudo' commands are routed to the agent without running sudo
+        ret_code, stdout = tools.exec([ 'sudo', 'echo', 'agent' ])
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(stdout, "agent\n")
+        tools.cmd_timeouts.update({ 'sleep': 0.5 })
+        ret_code, stdout = tools.exec([ 'sudo', 'sleep', '5' ], dev_ref='/dev/nvme99')
+        self.assertEqual(ret_code, LinuxToolsHelper.RET_TIMEOUT)
+        self.assertTrue(tools.is_unresponsive('/dev/nvme99'))
+        tools.stop_agent()
+        self.assertIsNone(tools.agent)
+
+
+if __name__ == '__main__':
+    unittest.main()
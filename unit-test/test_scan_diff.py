@@ -0,0 +1,96 @@
+import unittest
+import copy
+from scan_diff import NvmeScanDiff
+
+
+def make_ctrl(serial, cntlid, bdf, dev_node, fw, ns_list):
+    return {
+        'type':     'id_controller',
+        'bdf':      bdf,
+        'dev_node': dev_node,
+        'state':    'ok',
+        'cntlid':   cntlid,
+        'id_ctrl':  { 'sn': serial + '   ', 'cntlid': cntlid, 'fr': fw, 'tnvmcap': 960197124096 },
+        'list_ns':  [ { 'ns_id': ns_id, 'ns_index': index, 'id_ns': { 'nsze': nsze } }
+                      for index, (ns_id, nsze) in enumerate(ns_list) ]
+    }
+
+
+class ScanDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.old_scan = { 'ctrl_list': [
+            make_ctrl('SN0001', 1, '0000:02:00.0', '/dev/nvme0', 'E2MU110', [ (1, 1000), (2, 2000) ]),
+            make_ctrl('SN0002', 1, '0000:03:00.0', '/dev/nvme1', 'E2MU110', [ (1, 1000) ]),
+            make_ctrl('SN0003', 1, '0000:04:00.0', '/dev/nvme2', 'E2MU110', [ (1, 1000) ])
+        ] }
+
+    def test_01_no_change_on_reorder(self):
+        # enumeration order and dev node changes alone are not a difference
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['ctrl_list'].reverse()
+        self.assertEqual(NvmeScanDiff(self.old_scan, new_scan).diff(), [])
+        self.assertEqual(str(NvmeScanDiff(self.old_scan, new_scan)), "")
+
+    def test_02_field_changes(self):
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['ctrl_list'][0]['id_ctrl']['fr'] = 'E2MU200'
+        new_scan['ctrl_list'][1]['bdf'] = '0000:05:00.0'
+        new_scan['ctrl_list'][0]['list_ns'].pop(1)
+        changes = NvmeScanDiff(self.old_scan, new_scan).diff()
+        self.assertIn({ 'change': 'modified', 'object': 'controller', 'key': ('SN0001', 1),
+                        'field': 'fw', 'old': 'E2MU110', 'new': 'E2MU200' }, changes)
+        self.assertIn({ 'change': 'modified', 'object': 'controller', 'key': ('SN0002', 1),
+                        'field': 'bdf', 'old': '0000:03:00.0', 'new': '0000:05:00.0' }, changes)
+        self.assertIn({ 'change': 'removed', 'object': 'namespace', 'key': ('SN0001', 2),
+                        'field': None, 'old': None, 'new': None }, changes)
+        self.assertEqual(len(changes), 3)
+        # restrict the compared fields
+        changes = NvmeScanDiff(self.old_scan, new_scan, ctrl_fields=['fw'], ns_fields=[]).diff()
+        self.assertEqual(len(changes), 2)
+
+    def test_03_added_removed_controllers(self):
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['ctrl_list'].pop(2)
+        new_scan['ctrl_list'].append(make_ctrl('SN0004', 1, '0000:04:00.0', '/dev/nvme2', 'E2MU110', [ (1, 1000) ]))
+        changes = NvmeScanDiff(self.old_scan, new_scan).diff()
+        # namespaces of added or removed drives are implied by the controller
+        self.assertEqual(sorted([ (change['change'], change['key']) for change in changes ]),
+                         [ ('added', ('SN0004', 1)), ('removed', ('SN0003', 1)) ])
+        scan_diff = NvmeScanDiff(self.old_scan, new_scan)
+        self.assertIn("controller sn=SN0003 cntlid=1 removed", str(scan_diff))
+
+    def test_04_unresponsive_controller(self):
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['ctrl_list'][0]['state']   = 'unresponsive'
+        new_scan['ctrl_list'][0]['list_ns'] = None
+        changes = NvmeScanDiff(self.old_scan, new_scan).diff()
+        # namespaces of a hung controller are unknown, not dropped
+        self.assertEqual(changes, [ { 'change': 'modified', 'object': 'controller', 'key': ('SN0001', 1),
+                                      'field': 'state', 'old': 'ok', 'new': 'unresponsive' } ])
+        # a hung controller has no identify data, it is aligned by BDF
+        new_scan['ctrl_list'][0]['id_ctrl'] = {}
+        new_scan['ctrl_list'][0]['cntlid']  = None
+        changes = NvmeScanDiff(self.old_scan, new_scan, ctrl_fields=['state', 'bdf']).diff()
+        self.assertEqual(changes, [ { 'change': 'modified', 'object': 'controller', 'key': ('SN0001', 1),
+                                      'field': 'state', 'old': 'ok', 'new': 'unresponsive' } ])
+
+    def test_05_unidentified_controller(self):
+        new_scan = copy.deepcopy(self.old_scan)
+        # id-ctrl failed without a timeout on two controllers
+        for dev_data in new_scan['ctrl_list'][:2]:
+            dev_data['id_ctrl'] = {}
+            dev_data['cntlid']  = None
+        _, ns_index, _ = NvmeScanDiff.index_scan(new_scan)
+        self.assertEqual(sorted(ns_index.keys()), [ ('SN0003', 1) ])
+        # their namespaces are unknown rather than dropped
+        changes = NvmeScanDiff(self.old_scan, new_scan, ctrl_fields=['bdf']).diff()
+        self.assertEqual(changes, [])
+
+    def test_06_invalid_field(self):
+        with self.assertRaises(ValueError):
+            NvmeScanDiff(self.old_scan, self.old_scan, ctrl_fields=['no_such_field'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import urllib.request
+import urllib.error
+import threading
+from scan_exporter import NvmeMetricsCollector, make_exporter
+from test_scan_diff import make_ctrl
+
+
+# device collector replacement that counts scans and health queries
+class FakeCollector(object):
+
+    class FakeToolsHelper(object):
+        def __init__(self):
+            self.smart_count = 0
+
+        def log(self, err_lvl, msg_text):
+            print("{}: {}".format(err_lvl, msg_text))
+
+        def pcie_get_link_status(self, bdf):
+            return { 'current_link_width': 2, 'current_link_speed': '8.0 GT/s PCIe',
+                     'max_link_width': 4, 'max_link_speed': '8.0 GT/s PCIe' }
+
+        def nvme_get_smart_log(self, dev_node):
+            self.smart_count += 1
+            return { 'temperature': 310, 'critical_warning': 0, 'percent_used': 3,
+                     'media_errors': 0, 'num_err_log_entries': 12 }
+
+    def __init__(self):
+        self.tools_hlpr = self.FakeToolsHelper()
+        self.scan_count = 0
+        self.fail       = False
+
+    def new_scan(self):
+        self.scan_count += 1
+        if self.fail:
+            raise OSError("scan failed")
+        hung_ctrl = make_ctrl('SN0002', 1, '0000:03:00.0', '/dev/nvme1', 'E2MU110', [])
+        hung_ctrl.update({ 'state': 'unresponsive', 'cntlid': None, 'id_ctrl': {}, 'list_ns': None })
+        return { 'ctrl_list': [
+            make_ctrl('SN0001', 1, '0000:02:00.0', '/dev/nvme0', 'E2MU110', [ (1, 1000), (2, 2000) ]),
+            hung_ctrl
+        ] }
+
+
+class ScanExporterTestCase(unittest.TestCase):
+
+    def test_01_render(self):
+        collector = FakeCollector()
+        metrics   = NvmeMetricsCollector(collector, interval=3600)
+        self.assertTrue(metrics.refresh())
+        text = metrics.snapshot().decode('utf-8')
+        self.assertTrue(text.endswith("# EOF\n"))
+        labels = 'serial="SN0001",cntlid="1",bdf="0000:02:00.0",dev_node="/dev/nvme0"'
+        self.assertIn('nvme_namespace_count{' + labels + '} 2', text)
+        self.assertIn('nvme_pcie_link_width{' + labels + '} 2', text)
+        self.assertIn('nvme_temperature_celsius{' + labels + '} 37', text)
+        self.assertIn('nvme_controller_responsive{serial="",cntlid="",bdf="0000:03:00.0",dev_node="/dev/nvme1"} 0',
+                      text)
+        # no health queries are sent to an unresponsive controller
+        self.assertEqual(collector.tools_hlpr.smart_count, 1)
+
+    def test_02_scrape_uses_snapshot(self):
+        collector = FakeCollector()
+        metrics   = NvmeMetricsCollector(collector, interval=3600)
+        metrics.start()
+        server    = make_exporter(metrics, port=0)
+        thread    = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        try:
+            for _ in range(5):
+                with urllib.request.urlopen(url) as response:
+                    self.assertEqual(response.headers['Content-Type'], NvmeMetricsCollector.CONTENT_TYPE)
+                    self.assertEqual(response.read(), metrics.snapshot())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url.replace('/metrics', '/other'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            metrics.stop()
+        # scrapes never trigger scans
+        self.assertEqual(collector.scan_count, 1)
+
+    def test_03_failed_scan(self):
+        collector = FakeCollector()
+        metrics   = NvmeMetricsCollector(collector, interval=3600)
+        self.assertTrue(metrics.refresh())
+        self.assertIn('nvme_scan_errors 0', metrics.snapshot().decode('utf-8'))
+        collector.fail = True
+        self.assertFalse(metrics.refresh())
+        # the last scan data is kept, the error count is updated
+        text = metrics.snapshot().decode('utf-8')
+        self.assertIn('nvme_scan_errors 1', text)
+        self.assertIn('nvme_namespace_count{serial="SN0001",cntlid="1",bdf="0000:02:00.0",dev_node="/dev/nvme0"} 2',
+                      text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from scan_query import ScanQuery, ScanIndex
+from test_scan_diff import make_ctrl
+
+
+class ScanQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        ctrl_list = []
+        for index, (model, fw, root) in enumerate([ ('Micron_7450', 'E2MU110', '0000:00:01.1'),
+                                                    ('Micron_7450', 'E2MU200', '0000:00:01.1'),
+                                                    ('Micron_7400', 'E1MU100', '0000:00:01.1'),
+                                                    ('Micron_7450', 'E2MU110', '0000:00:03.1') ]):
+            bdf  = '0000:0{}:00.0'.format(index + 2)
+            ctrl = make_ctrl('SN000{}'.format(index), 1, bdf, '/dev/nvme{}'.format(index), fw, [ (1, 1000) ])
+            ctrl['id_ctrl'].update({ 'mn': model + '   ', 'vid': 4932 })
+            ctrl['udev_path'] = '/devices/pci0000:00/{}/{}/nvme/nvme{}'.format(root, bdf, index)
+            ctrl_list.append(ctrl)
+        self.scan = { 'ctrl_list': ctrl_list }
+
+    def _nodes(self, query_str):
+        return [ dev_data['dev_node'] for dev_data in ScanQuery(query_str).run(self.scan) ]
+
+    def test_01_example_query(self):
+        self.assertEqual(self._nodes('model~"7450" and fw<"E2MU200" and root=0000:00:01.1'), [ '/dev/nvme0' ])
+
+    def test_02_operators(self):
+        self.assertEqual(self._nodes('node=/dev/nvme2'), [ '/dev/nvme2' ])
+        self.assertEqual(self._nodes('fw>=E2MU200'), [ '/dev/nvme1' ])
+        self.assertEqual(self._nodes('fw!=E2MU110'), [ '/dev/nvme1', '/dev/nvme2' ])
+        self.assertEqual(self._nodes('(node=/dev/nvme0 or node=/dev/nvme3) and not root=0000:00:03.1'),
+                         [ '/dev/nvme0' ])
+        self.assertEqual(self._nodes('cntlid=1 and ns_count>0'), [ '/dev/nvme0', '/dev/nvme1', '/dev/nvme2', '/dev/nvme3' ])
+        self.assertEqual(self._nodes('model = "Micron_7400"'), [ '/dev/nvme2' ])
+        # unindexed id_ctrl fields are scanned
+        self.assertEqual(len(self._nodes('vid=0x1344 and capacity>1000')), 4)
+        self.assertEqual(self._nodes('serial~"3$" OR state=unresponsive'), [ '/dev/nvme3' ])
+
+    def test_03_reuse_index(self):
+        scan_index = ScanIndex(self.scan)
+        self.assertEqual(len(ScanQuery('bdf=0000:02:00.0').run(scan_index)), 1)
+        self.assertEqual(len(ScanQuery('upstream=0000:00:01.1').run(scan_index)), 0)
+        self.assertEqual(scan_index.indexes['root']['0000:00:01.1'], set([ 0, 1, 2 ]))
+
+    def test_04_syntax_errors(self):
+        for query_str in [ 'model', 'model=', '(fw=E2MU110', 'fw=E2MU110 and', 'fw=E2MU110 xor bdf=1',
+                           'model~"("' ]:
+            with self.assertRaises(ValueError):
+                ScanQuery(query_str)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+import copy
+from datetime import datetime
+from scan_store import NvmeScanStore
+from test_scan_diff import make_ctrl
+
+
+class ScanStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store    = NvmeScanStore(':memory:')
+        self.old_scan = { 'timestamp': '2020-11-19T10:00:00', 'ctrl_list': [
+            make_ctrl('SN0001', 1, '0000:02:00.0', '/dev/nvme0', 'E2MU110', [ (1, 1000), (2, 2000) ]),
+            make_ctrl('SN0002', 1, '0000:03:00.0', '/dev/nvme1', 'E2MU110', [ (1, 1000) ])
+        ] }
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_01_payload_dedup(self):
+        self.store.add_scan(self.old_scan, host='host_a')
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['timestamp'] = '2020-11-20T10:00:00'
+        self.store.add_scan(new_scan, host='host_a')
+        # both drives have identical identify data except for serial number,
+        # namespaces share identical id_ns payloads
+        count = self.store.conn.execute("SELECT COUNT(*) FROM payloads").fetchone()[0]
+        self.assertEqual(count, 4)
+        count = self.store.conn.execute("SELECT COUNT(*) FROM controllers").fetchone()[0]
+        self.assertEqual(count, 4)
+
+    def test_02_serial_history(self):
+        self.store.add_scan(self.old_scan, host='host_a')
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['timestamp'] = '2020-11-20T10:00:00'
+        new_scan['ctrl_list'][0]['bdf'] = '0000:05:00.0'
+        self.store.add_scan(new_scan, host='host_a')
+        history = self.store.serial_history('SN0001')
+        self.assertEqual([ item['bdf'] for item in history ], [ '0000:02:00.0', '0000:05:00.0' ])
+        self.assertEqual(history[0]['fw'], 'E2MU110')
+        self.assertEqual(len(self.store.bdf_history('0000:02:00.0', host='host_a')), 1)
+        self.assertEqual(len(self.store.bdf_history('0000:02:00.0', host='host_b')), 0)
+        id_ctrl_hash = self.store.conn.execute("SELECT id_ctrl_hash FROM controllers LIMIT 1").fetchone()[0]
+        self.assertEqual(self.store.get_payload(id_ctrl_hash)['sn'].strip(), 'SN0001')
+
+    def test_03_namespace_events(self):
+        self.store.add_scan(self.old_scan, host='host_a')
+        # another host scanned in between does not affect host_a events
+        self.store.add_scan({ 'ctrl_list': [] }, host='host_b', timestamp='2020-11-19T12:00:00')
+        new_scan = copy.deepcopy(self.old_scan)
+        new_scan['timestamp'] = '2020-11-20T10:00:00'
+        new_scan['ctrl_list'][0]['list_ns'].pop(1)
+        new_scan['ctrl_list'][1]['list_ns'].append({ 'ns_id': 2, 'ns_index': 1, 'id_ns': { 'nsze': 10 } })
+        self.store.add_scan(new_scan, host='host_a')
+        drops = self.store.namespace_events('drop', since=datetime(2020, 11, 20))
+        self.assertEqual(drops, [ { 'host': 'host_a', 'timestamp': '2020-11-20T10:00:00',
+                                    'serial': 'SN0001', 'nsid': 2, 'event': 'drop' } ])
+        self.assertEqual(self.store.namespace_events('drop', until=datetime(2020, 11, 20)), [])
+        attaches = self.store.namespace_events('attach', host='host_a')
+        self.assertEqual([ (item['serial'], item['nsid']) for item in attaches ], [ ('SN0002', 2) ])
+
+    def test_04_out_of_order(self):
+        scan_a = self.old_scan
+        scan_c = copy.deepcopy(self.old_scan)
+        scan_c['timestamp'] = '2020-11-21T10:00:00'
+        scan_c['ctrl_list'][0]['list_ns'].pop(1)
+        scan_b = copy.deepcopy(scan_c)
+        scan_b['timestamp'] = '2020-11-20T10:00:00'
+        self.store.add_scan(scan_a, host='host_a')
+        self.store.add_scan(scan_c, host='host_a')
+        self.store.add_scan(scan_b, host='host_a')
+        drops = self.store.namespace_events('drop')
+        self.assertEqual([ (item['timestamp'], item['serial'], item['nsid']) for item in drops ],
+                         [ ('2020-11-20T10:00:00', 'SN0001', 2) ])
+        self.assertEqual(self.store.namespace_events('attach'), [])
+
+    def test_05_duplicate_scan(self):
+        self.assertIsNotNone(self.store.add_scan(self.old_scan, host='host_a'))
+        self.assertIsNone(self.store.add_scan(copy.deepcopy(self.old_scan), host='host_a'))
+        self.assertIsNotNone(self.store.add_scan(self.old_scan, host='host_b'))
+        count = self.store.conn.execute("SELECT COUNT(*) FROM scans").fetchone()[0]
+        self.assertEqual(count, 2)
+        count = self.store.conn.execute("SELECT COUNT(*) FROM controllers").fetchone()[0]
+        self.assertEqual(count, 4)
+
+    def test_06_unidentified_controller(self):
+        new_scan = copy.deepcopy(self.old_scan)
+        for dev_data in new_scan['ctrl_list']:
+            dev_data['id_ctrl'] = {}
+            dev_data['cntlid']  = None
+        self.store.add_scan(new_scan, host='host_a')
+        count = self.store.conn.execute("SELECT COUNT(*) FROM controllers WHERE serial IS NULL").fetchone()[0]
+        self.assertEqual(count, 2)
+        count = self.store.conn.execute("SELECT COUNT(*) FROM namespaces").fetchone()[0]
+        self.assertEqual(count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import os
+import time
 import unittest
 from tools_helper import LinuxToolsHelper
 from paramiko import SSHClient
@@ -245,6 +246,37 @@ class ToolsHelperTestCase(unittest.TestCase):
             self.assertEqual(alt_id_ctrl.get('mn', None),     id_ctrl['mn'])
             print(" -> id_ctrl (by id) confirmed for: {}".format(dev_node))
 
+    def test_14_local_exec_timeout(self):
+        local_tools = LinuxToolsHelper(cmd_timeouts={'sleep': 0.5}, retries=1, backoff=0.1)
+        self.assertEqual(local_tools.cmd_timeout(['sudo', 'sleep', '5']), 0.5)
+        self.assertEqual(local_tools.cmd_timeout(['/usr/bin/nvme', 'list']),
+                         LinuxToolsHelper.CMD_TIMEOUTS['nvme'])
+        # a hung command must be killed at its deadline, retried once, and
+        # then mark the device as unresponsive
+        start_time = time.monotonic()
+        ret_code, ret_text = local_tools.exec(['sleep', '5'], dev_ref='/dev/nvme99n1')
+        self.assertTrue(time.monotonic() - start_time < 4.0)
+        self.assertEqual(ret_code, LinuxToolsHelper.RET_TIMEOUT)
+        self.assertEqual(ret_text, "")
+        self.assertTrue(local_tools.is_unresponsive('/dev/nvme99'))
+        # further commands to the device are skipped without executing
+        ret_code, ret_text = local_tools.exec(['echo', 'skipped'], dev_ref='/dev/nvme99')
+        self.assertEqual(ret_code, LinuxToolsHelper.RET_UNRESPONSIVE)
+        # other devices are not affected
+        ret_code, ret_text = local_tools.exec(['echo', 'ok'], dev_ref='/dev/nvme98')
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(ret_text.strip(), 'ok')
+        local_tools.reset_unresponsive('/dev/nvme99')
+        self.assertFalse(local_tools.is_unresponsive('/dev/nvme99'))
+
+    def test_15_nvme_get_feature_parse(self):
+        local_tools = LinuxToolsHelper()
+        local_tools.exec = lambda cmd_list, cwd_opt=None, dev_ref=None: \
+            (0, "get-feature:0x07 (Number of Queues), Current value:0x003f003f\n")
+        self.assertEqual(local_tools.nvme_get_feature('/dev/nvme0', 7), 0x003f003f)
+        local_tools.exec = lambda cmd_list, cwd_opt=None, dev_ref=None: (1, "")
+        self.assertIsNone(local_tools.nvme_get_feature('/dev/nvme0', 7))
+
 
 if __name__ == '__main__':
     unittest.main()